@@ -8,9 +8,15 @@ import paho.mqtt.client as mqtt
 import json
 import base64
 import time
+import os
+import sys
 from PIL import Image
 import io
 
+# Binary envelope codec shared with Task 5 (repo root)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import image_codec
+
 # MQTT Configuration
 BROKER = "broker.mqttdashboard.com"
 PORT = 1883
@@ -21,11 +27,13 @@ CLIENT_ID = "Task4_Stego_Solver_001"
 HIDDEN_MESSAGE = "REEFING KRILLS :( CORALS BLOOM <3"  # From Task 3
 AGENT_ID = "shivaprasadvshivaprasad07"  # Your team ID
 CHALLENGE_CODE = "edrft_window"  # From Task 2
+CHUNK_TIMEOUT = 10.0  # Seconds before an incomplete chunked message is dropped
 
 # State variables
 image_received = True
 image_data = None
 running = True
+reassembler = image_codec.Reassembler(CHUNK_TIMEOUT)
 
 # ANSI Colors
 class Colors:
@@ -259,8 +267,11 @@ def on_connect(client, userdata, flags, rc):
         print(f"{Colors.GREEN}✓ Connected to MQTT Broker!{Colors.END}")
         
         # Subscribe to challenge code topic for image response
-        client.subscribe(CHALLENGE_CODE)
-        print(f"{Colors.GREEN}✓ Subscribed to: {CHALLENGE_CODE}{Colors.END}\n")
+        # Also the binary envelope and chunked variants, if the reef sends those
+        for topic in image_codec.receive_topics(CHALLENGE_CODE):
+            client.subscribe(topic)
+            print(f"{Colors.GREEN}✓ Subscribed to: {topic}{Colors.END}")
+        print()
         
         # Phase 1: Send request
         print(f"{Colors.YELLOW}Phase 1: Signaling the Reef...{Colors.END}")
@@ -283,17 +294,43 @@ def on_connect(client, userdata, flags, rc):
     else:
         print(f"{Colors.RED}✗ Connection failed with code {rc}{Colors.END}")
 
+def report_expired_chunks():
+    """Drop chunked messages that stopped arriving"""
+    for topic, msg_id, have, count in reassembler.expire():
+        print(f"{Colors.RED}✗ Chunked message {msg_id:08x} on {topic} timed out "
+              f"({have}/{count} chunks){Colors.END}\n")
+
 def on_message(client, userdata, msg):
     """Callback when message received from MQTT broker"""
     global image_received, image_data, running
     
+    topic, data = msg.topic, msg.payload
     try:
+        # Chunked messages are buffered until every chunk has arrived
+        if image_codec.is_chunk_topic(topic):
+            report_expired_chunks()
+            done = reassembler.push(topic, data)
+            if done is None:
+                return
+            topic, data = done
+            print(f"{Colors.GREEN}✓ Reassembled {len(data)} bytes from chunks{Colors.END}")
+        
         print(f"\n{Colors.GREEN}{'═' * 52}{Colors.END}")
-        print(f"{Colors.GREEN}Message received on topic: {msg.topic}{Colors.END}")
+        print(f"{Colors.GREEN}Message received on topic: {topic}{Colors.END}")
         print(f"{Colors.GREEN}{'═' * 52}{Colors.END}\n")
         
-        # Parse the response
-        payload = json.loads(msg.payload.decode())
+        # Parse the response: binary envelope on "<topic>/bin", JSON otherwise
+        frame = None
+        if image_codec.is_binary_topic(topic):
+            frame = image_codec.unpack(data)
+            payload = {
+                "type": "envelope/" + image_codec.ENCODING_NAMES.get(frame.encoding, "?"),
+                "width": frame.width,
+                "height": frame.height,
+                "data": frame.payload
+            }
+        else:
+            payload = json.loads(data.decode())
         
         print(f"{Colors.CYAN}Payload keys: {list(payload.keys())}{Colors.END}")
         
@@ -303,17 +340,22 @@ def on_message(client, userdata, msg):
             print(f"  Type: {payload.get('type')}")
             print(f"  Width: {payload.get('width')}")
             print(f"  Height: {payload.get('height')}")
-            print(f"  Data length: {len(payload['data'])} characters\n")
+            print(f"  Data length: {len(payload['data'])} {'bytes' if frame else 'characters'}\n")
             
             # Phase 2: Restore the image
             print(f"{Colors.YELLOW}Phase 2: Restoring Image...{Colors.END}")
             
-            # Decode base64 image data
-            image_bytes = base64.b64decode(payload['data'])
-            print(f"{Colors.GREEN}✓ Decoded base64 data: {len(image_bytes)} bytes{Colors.END}")
-            
-            # Create PIL Image
-            image = Image.open(io.BytesIO(image_bytes))
+            if frame:
+                # Envelope CRC already checked; pixels are lossless (raw/zlib/PNG)
+                image = image_codec.decode_image(frame)
+                print(f"{Colors.GREEN}✓ Decoded envelope: CRC verified{Colors.END}")
+            else:
+                # Decode base64 image data
+                image_bytes = base64.b64decode(payload['data'])
+                print(f"{Colors.GREEN}✓ Decoded base64 data: {len(image_bytes)} bytes{Colors.END}")
+                
+                # Create PIL Image
+                image = Image.open(io.BytesIO(image_bytes))
             print(f"{Colors.GREEN}✓ Image loaded successfully{Colors.END}")
             print(f"  Format: {image.format}")
             print(f"  Size: {image.size}")
@@ -430,9 +472,11 @@ def on_message(client, userdata, msg):
             print(json.dumps(payload, indent=2))
             print()
         
+    except image_codec.CodecError as e:
+        print(f"{Colors.RED}✗ Bad image envelope or chunk: {e}{Colors.END}\n")
     except json.JSONDecodeError:
         print(f"{Colors.YELLOW}Non-JSON message received:{Colors.END}")
-        print(msg.payload.decode())
+        print(data.decode())
         print()
     except Exception as e:
         print(f"{Colors.RED}✗ Error processing message: {e}{Colors.END}")
@@ -471,6 +515,7 @@ def main():
         
         while running:
             time.sleep(1)
+            report_expired_chunks()
             
     except KeyboardInterrupt:
         print(f"\n{Colors.YELLOW}Interrupted by user{Colors.END}")
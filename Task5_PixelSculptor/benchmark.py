@@ -0,0 +1,486 @@
+#!/usr/bin/env python3
+"""
+Task 5: The Pixel Sculptor - Benchmarks
+Offline timing harness for the transport engine (no MQTT needed)
+
+    python benchmark.py scheduler [--workers N] [--repeats R]
+    python benchmark.py sweep [--top K]
+    python benchmark.py auction [--tol T ...]
+    python benchmark.py scaling [--blocks B ...] [--sizes WxH ...] [--jobs N ...]
+                                [--out FILE] [--baseline FILE]
+    python benchmark.py stream [--frames F] [--threshold T]
+    python benchmark.py codec [--sizes WxH ...] [--repeats R]
+    python benchmark.py histogram [--repeats R]
+    python benchmark.py service [--size N] [--jobs N]
+"""
+
+import argparse
+import base64
+import io
+import json
+import multiprocessing
+import os
+import resource
+import subprocess
+import sys
+import time
+import numpy as np
+from PIL import Image
+from joblib.externals.loky import get_reusable_executor
+
+import main
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+SOURCE_PATH = os.path.join(HERE, "source_image.png")
+
+
+def bundled_pair():
+    """Bundled source image and target profile at pipeline resolution"""
+    profile, _ = main.load_target_profile(os.path.join(HERE, main.TARGET_IMAGE_PATH))
+    with open(SOURCE_PATH, "rb") as f:
+        source = main.decode_source(f.read())
+    return source, profile
+
+
+def random_jobs(n_blocks, block=main.BLOCK, seed=0):
+    """Synthetic tile jobs shaped like the ones advanced_optimal_transport builds"""
+    rng = np.random.default_rng(seed)
+    jobs = []
+    for _ in range(n_blocks):
+        s = rng.integers(0, 256, (block, block, 3), dtype=np.uint8)
+        t = rng.integers(0, 256, (block, block, 3), dtype=np.uint8)
+        jobs.append((s, t, main.compute_feature_map(s), main.compute_feature_map(t)))
+    return jobs
+
+
+def best_of(fn, repeats):
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+# =============== SCHEDULER ==================
+def bench_scheduler(workers, repeats, counts=(16, 32, 64, 128, 256, 512, 1024, 2048, 4096)):
+    """Compare in-process and pooled tile solving and report the break-even"""
+    main.N_JOBS = workers
+    pool = main.get_worker_pool()
+    # Spawn and import in the workers now, not inside the first timing
+    main.warm_worker_pool()
+
+    # Per-tile compute cost inside a full batch (tiles are costed and solved
+    # SOLVE_BATCH at a time, so a lone tile overstates it), and the fixed pool
+    # round-trip cost
+    batch = random_jobs(main.SOLVE_BATCH)
+    main.process_block_chunk(batch)
+    t_block = best_of(lambda: main.process_block_chunk(batch), repeats) / len(batch)
+    empty = [[] for _ in range(workers)]
+    t_pool = best_of(
+        lambda: pool(main.delayed(main.process_block_chunk)(c) for c in empty),
+        repeats
+    )
+    # Shipping tiles to workers and back without solving them
+    shipped = [batch[w::workers] for w in range(workers)]
+    t_ship = best_of(lambda: pool(main.delayed(list)(c) for c in shipped), repeats)
+    t_xfer = max(0.0, t_ship - t_pool) / len(batch)
+
+    print(f"[*] workers={workers} tile={t_block * 1e3:.3f} ms transfer={t_xfer * 1e3:.3f} ms/tile "
+          f"pool round-trip={t_pool * 1e3:.2f} ms ({t_pool / workers * 1e3:.3f} ms/worker)")
+    print(f"{'tiles':>6} {'inline ms':>10} {'pooled ms':>10}")
+
+    measured = None
+    for n in counts:
+        jobs = random_jobs(n, seed=n)
+        t_inline = best_of(lambda: main.schedule_blocks(jobs, min_parallel=float("inf")), repeats)
+        t_pooled = best_of(lambda: main.schedule_blocks(jobs, min_parallel=0), repeats)
+        print(f"{n:>6} {t_inline * 1e3:>10.2f} {t_pooled * 1e3:>10.2f}")
+        if measured is None and t_pooled < t_inline:
+            measured = n
+
+    modelled = main.pool_break_even(workers, t_block, t_xfer, t_pool / workers)
+    print(f"[✓] break-even measured={measured} modelled={modelled} "
+          f"(configured model: {main.parallel_min_blocks(workers)} tiles)")
+    print(f"[*] POOL_TILE_SECONDS={t_block:.2e} POOL_TRANSFER_SECONDS={t_xfer:.2e} "
+          f"POOL_DISPATCH_SECONDS={t_pool / workers:.2e}")
+    main.shutdown_worker_pool()
+
+
+# =============== SWEEP ==================
+def bench_sweep(top):
+    """Parameter sweep on the bundled pair: best config and SSIM/runtime Pareto table"""
+    source, profile = bundled_pair()
+    result = main.sweep_parameters(source, profile.image(), profile)
+    keys = list(main.DEFAULT_PARAMS)
+
+    def show(rows):
+        print(" ".join(f"{k[:8]:>8}" for k in keys) + f" {'ssim':>7} {'ms':>7}")
+        for row in rows:
+            values = " ".join(f"{row['params'][k]:>8.2f}" for k in keys)
+            print(f"{values} {row['ssim']:>7.4f} {row['seconds'] * 1e3:>7.1f}")
+
+    print(f"[*] {len(result['rows'])} candidates, top {top} by SSIM")
+    show(sorted(result["rows"], key=lambda r: -r["ssim"])[:top])
+    print("[*] Pareto front (SSIM vs runtime)")
+    show(result["pareto"])
+    print(f"[✓] best: {result['best']['params']} SSIM={result['best']['ssim']:.4f}")
+
+
+# =============== AUCTION ==================
+def bundled_costs():
+    """(B, n, n) full-scale tile cost matrices for the bundled pair"""
+    source, profile = bundled_pair()
+    src = main.match_histograms_lut(main.as_array(source), profile.cdfs)
+    tgt = profile.pyramid[main.IMG_SIZE]
+    jobs, _ = main.block_jobs(
+        src, tgt, main.compute_feature_map(src), profile.features[main.IMG_SIZE],
+        main.color_coordinates(src), profile.colors(),
+        (main.DEFAULT_PARAMS["spatial_weight"], main.DEFAULT_PARAMS["feature_weight"])
+    )
+    return np.stack([main.block_cost(*job) for job in jobs])
+
+
+def bench_auction(tols, repeats):
+    """Batched auction vs per-tile SciPy Hungarian: time and optimality gap"""
+    cost = bundled_costs()
+    B, n, _ = cost.shape
+
+    def totals(cols):
+        return np.take_along_axis(cost, cols[:, :, None], axis=2).sum(axis=(1, 2))
+
+    main.ASSIGNMENT_BACKEND = "hungarian"
+    t_scipy = best_of(lambda: main.solve_assignments(cost), repeats)
+    optimal = totals(main.solve_assignments(cost))
+
+    print(f"[*] {B} tiles of {n}x{n}")
+    print(f"{'solver':>16} {'ms':>8} {'mean gap %':>11} {'max gap %':>10}")
+    print(f"{'scipy':>16} {t_scipy * 1e3:>8.1f} {0.0:>11.3f} {0.0:>10.3f}")
+
+    for tol in tols:
+        t_auction = best_of(lambda: main.auction_assign(cost, tol), repeats)
+        gap = (totals(main.auction_assign(cost, tol)) - optimal) / optimal * 100
+        print(f"{f'auction {tol:g}':>16} {t_auction * 1e3:>8.1f} "
+              f"{gap.mean():>11.3f} {gap.max():>10.3f}")
+
+
+# =============== STREAM ==================
+def moving_patch_frames(n_frames, patch=16, step=4):
+    """Bundled source with a patch of its own pixels sliding across it, one step per frame"""
+    source, _ = bundled_pair()
+    base = main.as_array(source)
+    H, W = base.shape[:2]
+    tile = base[H - patch:, W - patch:].copy()
+    frames = []
+    for k in range(n_frames):
+        frame = base.copy()
+        x = (k * step) % (W - patch)
+        frame[(H - patch) // 2:(H + patch) // 2, x:x+patch] = tile
+        frames.append(frame)
+    return frames
+
+
+def bench_stream(n_frames, threshold):
+    """Per-frame latency with tile reuse vs solving every tile, on a moving-patch sequence"""
+    _, profile = bundled_pair()
+    target = main.ImageBuffer(profile.pyramid[main.IMG_SIZE])
+    frames = moving_patch_frames(n_frames)
+
+    print(f"[*] {n_frames} frames at {main.IMG_SIZE[0]}x{main.IMG_SIZE[1]}, "
+          f"threshold={threshold}")
+    print(f"{'mode':>8} {'mean ms':>8} {'p95 ms':>8} {'fps':>6} {'reused %':>9} {'ssim':>7}")
+    for mode, thr in (("cold", -1.0), ("warm", threshold)):
+        stream = main.FrameStream(target, profile, threshold=thr)
+        stream.push(frames[0])
+        times, reused, total, scores = [], 0, 0, []
+        for frame in frames[1:]:
+            out, stats = stream.push(frame)
+            times.append(stats["seconds"])
+            reused += stats["reused"]
+            total += stats["reused"] + stats["solved"]
+            scores.append(main.compute_ssim(out, target))
+        times = np.array(times)
+        print(f"{mode:>8} {times.mean() * 1e3:>8.1f} {np.percentile(times, 95) * 1e3:>8.1f} "
+              f"{1 / times.mean():>6.1f} {100 * reused / total:>9.1f} {np.mean(scores):>7.4f}")
+
+
+# =============== SERVICE ==================
+# Runs in a child whose __main__ is main.py's code, as under `python main.py`
+# (minus the MQTT entry point), so pool tasks are pickled as the service does it
+SERVICE_CHECK = """
+import os, sys
+import numpy as np
+path, size, n_jobs = sys.argv[1], int(sys.argv[2]), int(sys.argv[3])
+sys.path.insert(0, os.path.dirname(path))
+__file__ = path
+with open(path) as f:
+    exec(compile(f.read().split('\\nif __name__ == "__main__":')[0], path, "exec"))
+
+rng = np.random.default_rng(0)
+src = rng.integers(0, 256, (size, size, 3), dtype=np.uint8)
+tgt = rng.integers(0, 256, (size, size, 3), dtype=np.uint8)
+N_JOBS = 1
+serial = np.asarray(tiled_transform(src, tgt))
+# Stage code must stay picklable by value too (no pool yet, so only its own state)
+from joblib.externals.loky.backend.reduction import dumps
+dumps(process_tile)
+N_JOBS = n_jobs
+pooled = np.asarray(tiled_transform(src, tgt))
+shutdown_worker_pool()
+assert np.array_equal(serial, pooled), "pooled tiles differ from serial"
+"""
+
+
+def check_service(size, n_jobs):
+    """Tiled transform through the pool with main.py executed as __main__"""
+    path = os.path.join(HERE, "main.py")
+    print(f"[*] {size}x{size} tiled transform, N_JOBS={n_jobs}, main.py as __main__")
+    proc = subprocess.run([sys.executable, "-c", SERVICE_CHECK, path, str(size), str(n_jobs)],
+                          capture_output=True, text=True)
+    if proc.returncode:
+        print(proc.stderr.strip().splitlines()[-1])
+        print("[!] Pooled tiled path failed under __main__")
+        raise SystemExit(1)
+    print("[✓] Pooled tiles match the serial run")
+
+
+# =============== HISTOGRAM ==================
+def bench_histogram(repeats):
+    """uint8/uint16 source x target matching, checked against the 8-bit result"""
+    source, profile = bundled_pair()
+    src8 = source.pixels
+    tgt8 = profile.pyramid[main.IMG_SIZE]
+    # x257 maps 0..255 onto 0..65535 exactly, so every depth should agree to 1 level
+    src16, tgt16 = src8.astype(np.uint16) * 257, tgt8.astype(np.uint16) * 257
+    reference = np.asarray(main.histogram_matching(src8, tgt8), dtype=np.float64)
+
+    print(f"{'source':>7} {'target':>7} {'ms':>8} {'max err (8-bit levels)':>23}")
+    for src_name, src in (("uint8", src8), ("uint16", src16)):
+        for tgt_name, tgt in (("uint8", tgt8), ("uint16", tgt16)):
+            out = np.asarray(main.histogram_matching(src, tgt))
+            assert out.dtype == src.dtype and out.shape == src.shape, (src_name, tgt_name)
+            err = np.abs(out / (257.0 if out.dtype == np.uint16 else 1.0) - reference).max()
+            assert err <= 1.0, f"{src_name} x {tgt_name}: off by {err:.2f} levels"
+            t = best_of(lambda: main.histogram_matching(src, tgt), repeats)
+            print(f"{src_name:>7} {tgt_name:>7} {t * 1e3:>8.2f} {err:>23.2f}")
+    print("[✓] All bit-depth combinations agree with the 8-bit match")
+
+
+# =============== CODEC ==================
+def json_message(pixels):
+    """Current wire format: base64 PNG in JSON"""
+    buf = io.BytesIO()
+    Image.fromarray(pixels).save(buf, format="PNG")
+    return json.dumps({"transformed_image": base64.b64encode(buf.getvalue()).decode()}).encode()
+
+
+def json_decode(message):
+    img = Image.open(io.BytesIO(base64.b64decode(json.loads(message)["transformed_image"])))
+    img.load()
+    return img
+
+
+def bench_codec(sizes, repeats):
+    """Message bytes and encode/decode CPU: JSON + base64 PNG vs binary envelopes"""
+    with open(SOURCE_PATH, "rb") as f:
+        source = Image.open(f).convert("RGB")
+        source.load()
+
+    formats = {"json+b64 png": (json_message, json_decode)}
+    for enc in main.image_codec.ENCODINGS:
+        formats[f"envelope {enc}"] = ((lambda p, enc=enc: main.image_codec.encode_image(p, enc)),
+                                      main.image_codec.decode_image)
+
+    print(f"{'size':>10} {'format':>14} {'bytes':>9} {'vs json':>8} {'enc ms':>8} {'dec ms':>8}")
+    for size in sizes:
+        pixels = np.asarray(source.resize(size, Image.Resampling.LANCZOS))
+        baseline = None
+        for name, (encode, decode) in formats.items():
+            message = encode(pixels)
+            assert np.array_equal(np.asarray(decode(message)), pixels), name
+            t_enc = best_of(lambda: encode(pixels), repeats)
+            t_dec = best_of(lambda: decode(message), repeats)
+            baseline = baseline or len(message)
+            print(f"{size[0]:>4}x{size[1]:<5} {name:>14} {len(message):>9} "
+                  f"{len(message) / baseline:>7.0%} {t_enc * 1e3:>8.2f} {t_dec * 1e3:>8.2f}")
+
+
+# =============== SCALING ==================
+SCALING_STAGES = {
+    "transport": main.advanced_optimal_transport,
+    "multi_scale": main.multi_scale_transform,
+}
+SCALING_BLOCKS = [4, 8, 16, 32]
+SCALING_SIZES = ["64x32", "128x64", "256x128", "512x256", "1024x512"]
+
+
+def scaled_pair(size):
+    """Bundled pair at (W, H), source histogram-matched as run_pipeline does"""
+    source = Image.open(SOURCE_PATH).convert("RGB").resize(size, Image.Resampling.LANCZOS)
+    target = Image.open(os.path.join(HERE, main.TARGET_IMAGE_PATH)).convert("RGB")
+    tgt = np.asarray(target.resize(size, Image.Resampling.LANCZOS))
+    return main.match_histograms_lut(np.asarray(source), main.histogram_cdfs(tgt)), tgt
+
+
+def peak_rss_mb(who):
+    # ru_maxrss is KiB on Linux, bytes on macOS
+    rss = resource.getrusage(who).ru_maxrss
+    return rss / (1 << 20 if sys.platform == "darwin" else 1 << 10)
+
+
+def scaling_point(stage, block, size, n_jobs, repeats, results):
+    """One grid point, run in a fresh process so peak RSS is its own"""
+    main.BLOCK, main.N_JOBS = block, n_jobs
+    fn = SCALING_STAGES[stage]
+    src, tgt = scaled_pair(size)
+
+    main.warm_worker_pool()
+    out = fn(src, tgt)
+    seconds = best_of(lambda: fn(src, tgt), repeats)
+    score = main.compute_ssim(out, tgt)
+
+    # Stop the pool so its workers are reaped and show up in RUSAGE_CHILDREN
+    main.shutdown_worker_pool()
+    get_reusable_executor().shutdown(wait=True)
+
+    pixels = size[0] * size[1]
+    results.put({
+        "stage": stage, "block": block, "width": size[0], "height": size[1],
+        "n_jobs": n_jobs, "seconds": seconds, "pixels_per_second": pixels / seconds,
+        "ssim": float(score), "peak_rss_mb": peak_rss_mb(resource.RUSAGE_SELF),
+        "workers_peak_rss_mb": peak_rss_mb(resource.RUSAGE_CHILDREN),
+    })
+
+
+def point_key(p):
+    return (p["stage"], p["block"], p["width"], p["height"], p["n_jobs"])
+
+
+def check_baseline(points, path, tolerance):
+    """Regressions against a previous scaling JSON: slower than tolerance or lower SSIM"""
+    with open(path) as f:
+        baseline = {point_key(p): p for p in json.load(f)["points"]}
+
+    failures = []
+    for p in points:
+        base = baseline.get(point_key(p))
+        if base is None:
+            continue
+        if p["pixels_per_second"] < (1 - tolerance) * base["pixels_per_second"]:
+            failures.append(f"{point_key(p)} throughput {p['pixels_per_second']:.0f} px/s "
+                            f"vs baseline {base['pixels_per_second']:.0f}")
+        if p["ssim"] < base["ssim"] - 1e-6:
+            failures.append(f"{point_key(p)} SSIM {p['ssim']:.4f} vs baseline {base['ssim']:.4f}")
+    return failures
+
+
+def bench_scaling(stages, blocks, sizes, jobs, repeats, out, baseline=None, tolerance=0.2):
+    """Throughput, SSIM and peak RSS over block size x image size x workers"""
+    ctx = multiprocessing.get_context("spawn")
+    results = ctx.Queue()
+    points = []
+
+    print(f"{'stage':>12} {'block':>5} {'size':>9} {'jobs':>4} {'Mpx/s':>8} "
+          f"{'ssim':>7} {'rss MB':>7} {'wrk MB':>7}")
+    for stage in stages:
+        for block in blocks:
+            for size in sizes:
+                for n_jobs in jobs:
+                    proc = ctx.Process(target=scaling_point,
+                                       args=(stage, block, size, n_jobs, repeats, results))
+                    proc.start()
+                    p = results.get()
+                    proc.join()
+                    points.append(p)
+                    print(f"{stage:>12} {block:>5} {f'{size[0]}x{size[1]}':>9} {n_jobs:>4} "
+                          f"{p['pixels_per_second'] / 1e6:>8.3f} {p['ssim']:>7.4f} "
+                          f"{p['peak_rss_mb']:>7.1f} {p['workers_peak_rss_mb']:>7.1f}")
+
+    meta = {
+        "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "cpu_count": os.cpu_count(),
+        "repeats": repeats,
+        "settings": main.run_settings(),
+    }
+    with open(out, "w") as f:
+        json.dump({"meta": meta, "points": points}, f, indent=2)
+    print(f"[✓] {len(points)} points written to {out}")
+
+    if baseline:
+        failures = check_baseline(points, baseline, tolerance)
+        for failure in failures:
+            print(f"[!] Regression: {failure}")
+        if failures:
+            raise SystemExit(1)
+        print(f"[✓] No regressions against {baseline}")
+
+
+def parse_size(text):
+    w, h = text.lower().split("x")
+    return int(w), int(h)
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Task 5 benchmarks")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    sched = sub.add_parser("scheduler", help="in-process vs pooled tile solving")
+    sched.add_argument("--workers", type=int, default=2)
+    sched.add_argument("--repeats", type=int, default=3)
+
+    sweep = sub.add_parser("sweep", help="parameter sweep with batched SSIM scoring")
+    sweep.add_argument("--top", type=int, default=10)
+
+    auction = sub.add_parser("auction", help="batched auction vs SciPy assignment")
+    auction.add_argument("--tol", type=float, nargs="+", default=[0.001, 0.01, 0.05, 0.2])
+    auction.add_argument("--repeats", type=int, default=3)
+
+    scaling = sub.add_parser("scaling", help="block size x image size x workers, to JSON")
+    scaling.add_argument("--stages", nargs="+", choices=list(SCALING_STAGES), default=list(SCALING_STAGES))
+    scaling.add_argument("--blocks", type=int, nargs="+", default=SCALING_BLOCKS)
+    scaling.add_argument("--sizes", type=parse_size, nargs="+", default=[parse_size(s) for s in SCALING_SIZES])
+    scaling.add_argument("--jobs", type=int, nargs="+",
+                         default=sorted({1, *range(2, (os.cpu_count() or 1) + 1, 2), os.cpu_count() or 1}))
+    scaling.add_argument("--repeats", type=int, default=2)
+    scaling.add_argument("--out", default="benchmark_scaling.json")
+    scaling.add_argument("--baseline", help="previous scaling JSON to gate against")
+    scaling.add_argument("--tolerance", type=float, default=0.2, help="allowed throughput drop")
+
+    stream = sub.add_parser("stream", help="sequence mode latency with tile reuse")
+    stream.add_argument("--frames", type=int, default=30)
+    stream.add_argument("--threshold", type=float, default=main.STREAM_THRESHOLD)
+
+    codec = sub.add_parser("codec", help="JSON + base64 vs binary envelope size and CPU")
+    codec.add_argument("--sizes", type=parse_size, nargs="+",
+                       default=[parse_size(s) for s in ("128x64", "512x256", "1024x512")])
+    codec.add_argument("--repeats", type=int, default=5)
+
+    histogram = sub.add_parser("histogram", help="uint8/uint16 histogram matching round trip")
+    histogram.add_argument("--repeats", type=int, default=5)
+
+    service = sub.add_parser("service", help="pooled tiled path with main.py run as __main__")
+    service.add_argument("--size", type=int, default=300)
+    service.add_argument("--jobs", type=int, default=2)
+
+    args = parser.parse_args()
+    if args.command == "scheduler":
+        bench_scheduler(args.workers, args.repeats)
+    elif args.command == "sweep":
+        bench_sweep(args.top)
+    elif args.command == "auction":
+        bench_auction(args.tol, args.repeats)
+    elif args.command == "stream":
+        bench_stream(args.frames, args.threshold)
+    elif args.command == "service":
+        check_service(args.size, args.jobs)
+    elif args.command == "histogram":
+        bench_histogram(args.repeats)
+    elif args.command == "codec":
+        bench_codec(args.sizes, args.repeats)
+    elif args.command == "scaling":
+        bench_scaling(args.stages, args.blocks, args.sizes, args.jobs, args.repeats,
+                      args.out, args.baseline, args.tolerance)
+
+
+if __name__ == "__main__":
+    main_cli()
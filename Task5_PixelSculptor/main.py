@@ -2,17 +2,35 @@
 
 import threading
 import json
+import tracemalloc
 import base64
 import io
+import hashlib
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+import itertools
+import time
+import traceback
 import numpy as np
 import os
-from PIL import Image, ImageFilter, ImageEnhance
+import sys
+import PIL
+import scipy
+import skimage
+from PIL import Image, ImageFilter
+from skimage.color import rgb2lab
 from skimage.metrics import structural_similarity as ssim
 from scipy.ndimage import gaussian_filter
 from scipy.optimize import linear_sum_assignment
-from joblib import Parallel, delayed
+from scipy.sparse import coo_matrix
+from scipy.sparse.csgraph import connected_components
+from joblib import Parallel, delayed, effective_n_jobs, parallel_config
 import paho.mqtt.client as mqtt
 
+# Binary envelope codec shared with Task 4 (repo root)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import image_codec
+
 # ================= CONFIG =================
 BROKER = "broker.mqttdashboard.com"
 PORT = 1883
@@ -22,58 +40,560 @@ TEAM_ID_REEF_ID = "shivaprasadvshivaprasad07_manojkumar10b35vshivaprasad07"
 CLIENT_ID = "Task5_Pixel_Sculptor_Final"
 
 TARGET_IMAGE_PATH = "target_image.jpg"
+TARGET_CACHE_DIR = ".target_cache"
 IMG_SIZE = (128, 64)
+# Working resolutions above TILE_SIZE^2 pixels run tile by tile. Tiles and halos
+# are multiples of 2 * BLOCK so both transport scales keep the global block grid
+TILE_SIZE = 256
+TILE_HALO = 16
 BLOCK = 8
+# Tile layout: "grid" (uniform BLOCK tiles) or "quadtree" over 2*BLOCK cells,
+# split by the target's gradient energy. Quadrants below QUADTREE_FLAT are
+# mapped by luminance rank without a solve; BLOCK tiles above QUADTREE_EDGE
+# split again, down to QUADTREE_MIN, so edges get small full assignments.
+# QUADTREE_EDGE_MODE = "merge" trades time for SSIM instead: edge-rich cells
+# are solved whole at 2*BLOCK (a wider search, several times the solve time)
+PARTITION = "grid"
+QUADTREE_FLAT = 8.0
+QUADTREE_EDGE = 20.0
+QUADTREE_MIN = 4
+QUADTREE_EDGE_MODE = "split"
+# Tile grids solved per transport: each extra grid is shifted diagonally by a
+# further BLOCK / TRANSPORT_GRIDS and solved in the same batch; the results are
+# reconciled into one permutation, so pixels can move across the first grid's seams
+TRANSPORT_GRIDS = 2
+# Colour term of the transport cost: "lab" (CIELAB, perceptual) or "rgb"
+COLOR_SPACE = "lab"
+# "blend": multi-scale blend + smoothing + contrast (synthesises colours)
+# "permutation": output is a rearrangement of the source pixels only
+OUTPUT_MODE = "blend"
+# L*a*b* axis weights: bring LAB distances onto the RGB-tuned cost scale and
+# favour lightness, which is what grayscale SSIM scores
+LAB_WEIGHTS = (12.0, 3.0, 3.0)
+# Hand-tuned stage weights; `sweep_parameters` searches around them
+DEFAULT_PARAMS = {
+    "spatial_weight": 3.0,   # transport cost per pixel of displacement
+    "feature_weight": 1.5,   # transport cost per unit of gradient mismatch
+    "blend": 0.7,            # share of the full-resolution result in the blend
+    "sigma": 0.4,            # Gaussian smoothing
+    "contrast": 1.05,        # contrast enhancement factor
+}
+# Per-tile assignment solver: "hungarian" (SciPy, exact) or "auction"
+# (batched NumPy epsilon-scaling; AUCTION_TOL trades optimality for speed)
+ASSIGNMENT_BACKEND = "hungarian"
+AUCTION_TOL = 0.05
+# SSIM refinement: swap evaluations per image (fixed, so runs are reproducible),
+# wall-clock budget used instead when REFINE_PROPOSALS is None, and swap radius
+REFINE_PROPOSALS = 4000
+REFINE_BUDGET = 0.5
+REFINE_RADIUS = 2
+REFINE_SEED = 0
+N_JOBS = -1
+# Seconds an idle pool worker survives. loky's default (300 s) would let an
+# MQTT service that sits quiet for 5 minutes respawn and re-import NumPy/SciPy
+# on the next message. ~11.5 days: workers poll with this as an int32 ms
+# timeout, which overflows past ~24 days
+POOL_IDLE_TIMEOUT = 10 ** 6
+# 8x8 tiles costed together as one (SOLVE_BATCH, 64, 64) tensor; larger tiles
+# are batched proportionally fewer at a time, so peak memory stays bounded
+SOLVE_BATCH = 256
+# Pool cost model behind the in-process fallback, measured with
+# `python benchmark.py scheduler --workers 2` (1-core host, warm pool): per
+# tile, solving inside a batch and shipping to a worker and back; per worker,
+# the fixed dispatch round-trip. PARALLEL_MIN_BLOCKS = None derives the
+# break-even from these for the current worker count (never on 2 workers,
+# ~43 tiles on 4, ~48 on 8); an int overrides it
+POOL_TILE_SECONDS = 0.27e-3
+POOL_TRANSFER_SECONDS = 0.16e-3
+POOL_DISPATCH_SECONDS = 0.45e-3
+PARALLEL_MIN_BLOCKS = None
+# Published format: "png" (base64 PNG in JSON on the team topic) or "ssd1306"
+# (1-bit page-major framebuffer on OLED_TOPIC: key frames every
+# OLED_KEYFRAME_INTERVAL frames, changed-byte deltas in between)
+PUBLISH_FORMAT = "png"
+OLED_TOPIC = TEAM_ID_REEF_ID + "/oled"
+OLED_SIZE = (128, 64)
+# "ordered" (8x8 Bayer) keeps a local change local, so deltas stay small;
+# "floyd-steinberg" looks better on stills but its error ripples across frames
+OLED_DITHER = "ordered"
+OLED_KEYFRAME_INTERVAL = 30
+# Binary envelopes (image_codec) instead of JSON + base64: published on
+# "<topic>/bin"; sources are also accepted on SOURCE_TOPIC + "/bin".
+# BINARY_ENCODING is "raw", "zlib" or "png" (SSD1306 frames always go raw)
+BINARY_ENVELOPE = False
+BINARY_ENCODING = "zlib"
+# Published messages over CHUNK_SIZE bytes go out as chunks on "<topic>/chunk"
+# (0 disables). Chunks use CHUNK_QOS with up to CHUNK_WINDOW unacknowledged in
+# flight; incoming chunked sources missing pieces after CHUNK_TIMEOUT s are dropped
+CHUNK_SIZE = 64 * 1024
+CHUNK_QOS = 1
+CHUNK_WINDOW = 8
+CHUNK_TIMEOUT = 10.0
+# Sequence mode: each message is the next frame of a stream. A tile keeps its
+# previous assignment while its matched source pixels move by at most
+# STREAM_THRESHOLD levels on average; per-frame refinement is capped for latency
+SEQUENCE_MODE = False
+STREAM_THRESHOLD = 2.0
+STREAM_REFINE_PROPOSALS = 0
+# Ingest: decoded sources and published results kept per payload hash, so a
+# repeated message skips decoding and the pipeline. Downscales larger than
+# REDUCING_GAP decode JPEGs at a reduced DCT scale and pre-reduce before LANCZOS
+INGEST_CACHE_SIZE = 8
+REDUCING_GAP = 3.0
+# One JSON manifest per run, named by the hash of its inputs and settings
+MANIFEST_DIR = "manifests"
+# Stage spans: runs kept for the rolling summary, tracemalloc peaks (slows the
+# Python-heavy refine stage ~5x, so off by default), and a Chrome-trace JSON
+# (chrome://tracing, Perfetto) rewritten after each run when a path is set
+PROFILE_HISTORY = 20
+PROFILE_MEMORY = False
+TRACE_PATH = None
 # ==========================================
 
 source_image = None
+source_digest = None
+frame_stream = None
+oled_frame = None
+oled_frames = 0
 target_image = None
+target_profile = None
+target_digests = None
 target_ready = threading.Event()
+worker_pool = None
 
 # =============== PHASE 1 ==================
+def pyramid_sizes():
+    """(W, H) of every transport scale, full resolution first"""
+    return [IMG_SIZE, (IMG_SIZE[0]//2, IMG_SIZE[1]//2)]
+
+class TargetProfile:
+    """Everything derived from the fixed target image, computed once per session"""
+
+    VERSION = 2
+
+    def __init__(self, pyramid, features, lab, cdfs):
+        self.pyramid = pyramid      # (W, H) -> uint8 RGB array
+        self.features = features    # (W, H) -> gradient magnitude
+        self.lab = lab              # (W, H) -> CIELAB array
+        self.cdfs = cdfs            # (3, 256) per-channel CDFs at full size
+
+    @classmethod
+    def from_image(cls, img):
+        # Each level is resized from the previous one, as the pipeline does
+        pyramid = {}
+        for size in pyramid_sizes():
+            img = img.resize(size, Image.Resampling.LANCZOS)
+            pyramid[size] = np.array(img)
+
+        features = {size: compute_feature_map(arr) for size, arr in pyramid.items()}
+        lab = {size: rgb2lab(arr) for size, arr in pyramid.items()}
+        cdfs = histogram_cdfs(pyramid[IMG_SIZE])
+
+        return cls(pyramid, features, lab, cdfs)
+
+    def image(self, size=None):
+        return Image.fromarray(self.pyramid[size or IMG_SIZE])
+
+    def colors(self, size=None):
+        """Target pixels in the transport colour space"""
+        size = size or IMG_SIZE
+        if COLOR_SPACE == "lab":
+            return self.lab[size] * LAB_WEIGHTS
+        return self.pyramid[size].astype(np.float32)
+
+    def save(self, path):
+        arrays = {}
+        for size in self.pyramid:
+            key = f"{size[0]}x{size[1]}"
+            arrays[f"rgb_{key}"] = self.pyramid[size]
+            arrays[f"feat_{key}"] = self.features[size]
+            arrays[f"lab_{key}"] = self.lab[size]
+        arrays["cdfs"] = self.cdfs
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as data:
+            pyramid, features, lab = {}, {}, {}
+            for size in pyramid_sizes():
+                key = f"{size[0]}x{size[1]}"
+                pyramid[size] = data[f"rgb_{key}"]
+                features[size] = data[f"feat_{key}"]
+                lab[size] = data[f"lab_{key}"]
+            cdfs = data["cdfs"]
+
+        return cls(pyramid, features, lab, cdfs)
+
+def profile_cache_path(image_path):
+    """Cache file keyed by the target file's content hash and the pyramid layout"""
+    digest = hashlib.sha256()
+    with open(image_path, "rb") as f:
+        digest.update(f.read())
+    digest.update(f"v{TargetProfile.VERSION}:{pyramid_sizes()}".encode())
+
+    return os.path.join(TARGET_CACHE_DIR, digest.hexdigest()[:32] + ".npz")
+
+def load_target_profile(image_path):
+    """Load the target profile from the disk cache, building it on a miss"""
+    cache_path = profile_cache_path(image_path)
+
+    if os.path.exists(cache_path):
+        try:
+            return TargetProfile.load(cache_path), True
+        except Exception as e:
+            print("[!] Target cache unreadable, rebuilding:", e)
+
+    img = Image.open(image_path).convert("RGB")
+    profile = TargetProfile.from_image(img)
+
+    try:
+        profile.save(cache_path)
+    except OSError as e:
+        print("[!] Target cache not written:", e)
+
+    return profile, False
+
 def load_target_image_nonblocking():
-    global target_image
+    global target_image, target_profile, target_digests
     try:
         if not os.path.exists(TARGET_IMAGE_PATH):
             raise FileNotFoundError(TARGET_IMAGE_PATH)
 
-        img = Image.open(TARGET_IMAGE_PATH).convert("RGB")
-        img = img.resize(IMG_SIZE, Image.Resampling.LANCZOS)
-        target_image = img
+        target_profile, cached = load_target_profile(TARGET_IMAGE_PATH)
+        target_image = ImageBuffer(target_profile.pyramid[IMG_SIZE])
+        # Hashed once per session for run keys, not once per message
+        target_digests = {
+            "target_file_sha256": file_digest(TARGET_IMAGE_PATH),
+            "target_sha256": array_digest(target_image),
+        }
         target_ready.set()
 
-        print("[✓] Target image loaded from disk")
+        origin = "cache" if cached else "disk"
+        print(f"[✓] Target image loaded from {origin}")
 
     except Exception as e:
         print("[!] Target image load failed:", e)
 
-threading.Thread(target=load_target_image_nonblocking, daemon=True).start()
+# =============== IMAGE STORE ==================
+class ImageBuffer:
+    """uint8 RGB pixels (plain or memory-mapped) with derived arrays cached
+
+    Stages read pixels through as_array / as_float32 / gray_array, so an image
+    passed around as a buffer is converted at most once per representation.
+    """
+
+    def __init__(self, pixels):
+        self.pixels = pixels
+        self._cache = {}
+
+    @classmethod
+    def from_image(cls, img):
+        return cls(np.asarray(img.convert("RGB")))
+
+    @property
+    def size(self):
+        return self.pixels.shape[1], self.pixels.shape[0]
+
+    def _cached(self, key, fn):
+        if key not in self._cache:
+            self._cache[key] = fn()
+        return self._cache[key]
+
+    def float32(self):
+        return self._cached("float32", lambda: self.pixels.astype(np.float32))
+
+    def gray(self):
+        return self._cached("gray", lambda: rgb_to_gray(self.pixels))
+
+    def image(self):
+        return Image.fromarray(np.ascontiguousarray(self.pixels))
+
+class ImageStore:
+    """Directory of decoded images kept as .npy files and opened as read-only memmaps"""
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def path(self, name):
+        return os.path.join(self.root, name + ".npy")
+
+    def __contains__(self, name):
+        return os.path.exists(self.path(name))
+
+    def put(self, name, img):
+        pixels = as_array(img)
+        mm = np.lib.format.open_memmap(self.path(name), mode="w+", dtype=np.uint8, shape=pixels.shape)
+        mm[:] = pixels
+        mm.flush()
+        return self.get(name)
+
+    def get(self, name):
+        return ImageBuffer(np.load(self.path(name), mmap_mode="r"))
+
+class LRUCache:
+    """Small least-recently-used mapping"""
+
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self._items = OrderedDict()
+
+    def get(self, key):
+        if key not in self._items:
+            return None
+        self._items.move_to_end(key)
+        return self._items[key]
+
+    def put(self, key, value):
+        self._items[key] = value
+        self._items.move_to_end(key)
+        while len(self._items) > self.maxsize:
+            self._items.popitem(last=False)
+
+def decode_source(img_bytes, size=None):
+    """Decode an image payload to size, reducing large downscales early"""
+    size = size or IMG_SIZE
+    if image_codec.is_envelope(img_bytes):
+        img = image_codec.decode_image(img_bytes)
+    else:
+        img = Image.open(io.BytesIO(img_bytes))
+    if REDUCING_GAP:
+        # JPEG only: smallest DCT scale that stays REDUCING_GAP x the output
+        img.draft("RGB", (int(size[0] * REDUCING_GAP), int(size[1] * REDUCING_GAP)))
+    img = img.convert("RGB").resize(size, Image.Resampling.LANCZOS, reducing_gap=REDUCING_GAP)
+    return ImageBuffer.from_image(img)
+
+def rgb_to_gray(pixels):
+    """PIL's convert("L") on a uint8 RGB array (ITU-R 601-2, fixed point)"""
+    p = pixels.astype(np.uint32)
+    return ((p[..., 0] * 19595 + p[..., 1] * 38470 + p[..., 2] * 7471 + 0x8000) >> 16).astype(np.uint8)
+
+def as_array(img):
+    """uint8 pixels of a PIL image, ImageBuffer or array, without copying arrays"""
+    if isinstance(img, ImageBuffer):
+        return img.pixels
+    return np.asarray(img)
+
+def as_float32(img):
+    if isinstance(img, ImageBuffer):
+        return img.float32()
+    return np.asarray(img, dtype=np.float32)
+
+def gray_array(img):
+    if isinstance(img, ImageBuffer):
+        return img.gray()
+    if isinstance(img, np.ndarray):
+        return rgb_to_gray(img)
+    return np.asarray(img.convert("L"))
+
+def to_image(img):
+    if isinstance(img, ImageBuffer):
+        return img.image()
+    if isinstance(img, np.ndarray):
+        return Image.fromarray(img)
+    return img
+
+# =============== PROFILING ==================
+class StageProfiler:
+    """Nested spans over pipeline stages: wall time, CPU time, tracemalloc peak, workers
+
+    Spans only record between begin_run and end_run, so stage code running in
+    pool workers or outside run_pipeline pays a single attribute check.
+    """
+
+    def __init__(self, history=PROFILE_HISTORY):
+        self.runs = deque(maxlen=history)   # span lists of finished runs
+        self.events = None                  # spans of the run in progress
+        self._local = threading.local()
+        self._traced = False
+
+    def __reduce__(self):
+        # A copy that reaches a pool worker starts idle (worker spans are never
+        # recorded) and leaves the thread-local stacks behind
+        return StageProfiler, (self.runs.maxlen,)
+
+    def begin_run(self):
+        self.events = []
+        self._local.stack = []
+        self._t0 = time.perf_counter()
+        if PROFILE_MEMORY and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._traced = True
+
+    def end_run(self):
+        events, self.events = self.events, None
+        if self._traced:
+            tracemalloc.stop()
+            self._traced = False
+        events.sort(key=lambda e: e["start"])
+        self.runs.append(events)
+        return events
+
+    @contextmanager
+    def span(self, name):
+        if self.events is None:
+            yield
+            return
+
+        stack = self._local.__dict__.setdefault("stack", [])
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            current, peak = tracemalloc.get_traced_memory()
+            # The enclosing span keeps the peak reached so far before we reset it
+            if stack:
+                stack[-1]["peak"] = max(stack[-1]["peak"], peak)
+            tracemalloc.reset_peak()
+        else:
+            current = 0
+        event = {"name": name, "depth": len(stack), "workers": 1,
+                 "base": current, "peak": current}
+        stack.append(event)
+
+        start, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            event["wall"] = time.perf_counter() - start
+            event["cpu"] = time.process_time() - cpu
+            event["start"] = start - self._t0
+            stack.pop()
+            if tracing:
+                event["peak"] = max(event["peak"], tracemalloc.get_traced_memory()[1])
+                if stack:
+                    stack[-1]["peak"] = max(stack[-1]["peak"], event["peak"])
+            event["peak_bytes"] = event.pop("peak") - event.pop("base")
+            self.events.append(event)
+
+    def note_workers(self, n):
+        """Record the pool size used inside every open span (max over the span)"""
+        for event in getattr(self._local, "stack", ()):
+            event["workers"] = max(event["workers"], n)
+
+    def totals(self, events, depth=0):
+        """Wall seconds per span name at one nesting depth"""
+        out = {}
+        for e in events:
+            if e["depth"] == depth:
+                out[e["name"]] = out.get(e["name"], 0.0) + e["wall"]
+        return out
+
+    def summary(self):
+        """Per-stage mean/max over the rolling window of runs"""
+        stats = {}
+        for events in self.runs:
+            per_run = {}
+            for e in events:
+                row = per_run.setdefault(e["name"], {"wall": 0.0, "cpu": 0.0, "peak_bytes": 0,
+                                                     "workers": 1, "depth": e["depth"]})
+                row["wall"] += e["wall"]
+                row["cpu"] += e["cpu"]
+                row["peak_bytes"] = max(row["peak_bytes"], e["peak_bytes"])
+                row["workers"] = max(row["workers"], e["workers"])
+            for name, row in per_run.items():
+                stats.setdefault(name, []).append(row)
+
+        return {name: {
+            "runs": len(rows),
+            "depth": rows[0]["depth"],
+            "wall_mean": sum(r["wall"] for r in rows) / len(rows),
+            "wall_max": max(r["wall"] for r in rows),
+            "cpu_mean": sum(r["cpu"] for r in rows) / len(rows),
+            "peak_bytes": max(r["peak_bytes"] for r in rows),
+            "workers": max(r["workers"] for r in rows),
+        } for name, rows in stats.items()}
+
+    def print_summary(self):
+        print(f"[PROFILE] last {len(self.runs)} runs: stage, wall mean/max ms, "
+              f"cpu ms, peak KiB, workers")
+        for name, st in self.summary().items():
+            label = "  " * st["depth"] + name
+            peak = f"{st['peak_bytes'] / 1024:8.0f}" if PROFILE_MEMORY else f"{'-':>8}"
+            print(f"[PROFILE] {label:<18} {st['wall_mean'] * 1e3:8.1f} {st['wall_max'] * 1e3:8.1f} "
+                  f"{st['cpu_mean'] * 1e3:8.1f} {peak} {st['workers']:3d}")
+
+    def chrome_trace(self, path):
+        """Write the kept runs as Chrome trace events, one row (tid) per run"""
+        trace = []
+        for tid, events in enumerate(self.runs):
+            for e in events:
+                trace.append({
+                    "name": e["name"], "ph": "X", "pid": os.getpid(), "tid": tid,
+                    "ts": e["start"] * 1e6, "dur": e["wall"] * 1e6,
+                    "args": {"cpu_ms": e["cpu"] * 1e3, "peak_bytes": e["peak_bytes"],
+                             "workers": e["workers"]},
+                })
+        with open(path, "w") as f:
+            json.dump({"traceEvents": trace, "displayTimeUnit": "ms"}, f)
+
+profiler = StageProfiler()
 
 # =============== ADVANCED TECHNIQUES ==================
 
-def histogram_matching(source, target):
+def table_offsets(n_images, channels, levels):
+    """Offset of each (image, channel) table when tables are laid end to end"""
+    return (np.arange(n_images)[:, None, None] * channels + np.arange(channels)) * levels
+
+def histogram_cdfs(arr, levels=None):
+    """Per-channel CDFs of (..., H, W, C) integer images, shape (..., C, levels);
+    levels defaults to the dtype's range (256 for uint8, 65536 for uint16)"""
+    arr = np.asarray(arr)
+    levels = levels or np.iinfo(arr.dtype).max + 1
+    lead, channels = arr.shape[:-3], arr.shape[-1]
+    n_images = int(np.prod(lead))
+    flat = arr.reshape(n_images, -1, channels)
+
+    # One bincount covers every image and channel
+    idx = flat + table_offsets(n_images, channels, levels)
+    counts = np.bincount(idx.ravel(), minlength=n_images * channels * levels)
+    cdfs = np.cumsum(counts.reshape(n_images, channels, levels), axis=-1) / flat.shape[1]
+
+    return cdfs.reshape(lead + (channels, levels))
+
+def histogram_luts(src_cdfs, tgt_cdfs, dtype):
+    """Lookup tables sending each source level to the target level at the same quantile"""
+    levels = src_cdfs.shape[-1]
+    channels = tgt_cdfs.shape[0]
+    # A target CDF of another bit depth is stretched onto the source range
+    scale = (levels - 1) / (tgt_cdfs.shape[-1] - 1)
+
+    rows = src_cdfs.reshape(-1, channels, levels)
+    luts = np.empty(rows.shape, dtype=dtype)
+
+    for c in range(channels):
+        tgt_cdf = tgt_cdfs[c]
+        present = np.flatnonzero(np.diff(tgt_cdf, prepend=0))
+        for n in range(rows.shape[0]):
+            luts[n, c] = np.interp(rows[n, c], tgt_cdf[present], present * scale)
+
+    return luts.reshape(src_cdfs.shape)
+
+def match_histograms_lut(src, tgt_cdfs):
+    """Histogram-match (..., H, W, C) uint8/uint16 images against target CDFs"""
+    src = np.asarray(src)
+    if src.dtype not in (np.uint8, np.uint16):
+        raise ValueError(f"histogram matching needs uint8 or uint16 images, got {src.dtype}")
+
+    levels = np.iinfo(src.dtype).max + 1
+    luts = histogram_luts(histogram_cdfs(src, levels), tgt_cdfs, src.dtype)
+
+    # Single gather through all tables laid end to end
+    lead, channels = src.shape[:-3], src.shape[-1]
+    n_images = int(np.prod(lead))
+    idx = src.reshape(n_images, -1, channels) + table_offsets(n_images, channels, levels)
+
+    return luts.reshape(-1)[idx].reshape(src.shape)
+
+def histogram_matching(source, target, target_cdfs=None):
     """Match histogram of source to target for better color distribution"""
-    src_arr = np.array(source)
-    tgt_arr = np.array(target)
-    
-    matched = np.zeros_like(src_arr)
-    
-    for channel in range(3):
-        src_channel = src_arr[:, :, channel].flatten()
-        tgt_channel = tgt_arr[:, :, channel].flatten()
-        
-        src_values, src_counts = np.unique(src_channel, return_counts=True)
-        tgt_values, tgt_counts = np.unique(tgt_channel, return_counts=True)
-        
-        src_quantiles = np.cumsum(src_counts).astype(float) / src_channel.size
-        tgt_quantiles = np.cumsum(tgt_counts).astype(float) / tgt_channel.size
-        
-        interp_values = np.interp(src_quantiles, tgt_quantiles, tgt_values)
-        
-        matched_channel = np.interp(src_channel, src_values, interp_values)
-        matched[:, :, channel] = matched_channel.reshape(src_arr.shape[:2])
-    
-    return Image.fromarray(matched.astype(np.uint8))
+    if target_cdfs is None:
+        target_cdfs = histogram_cdfs(as_array(target))
+
+    matched = match_histograms_lut(as_array(source), target_cdfs)
+
+    # PIL has no 3-channel 16-bit mode; deeper results stay arrays
+    return Image.fromarray(matched) if matched.dtype == np.uint8 else matched
 
 def compute_feature_map(img_arr):
     """Compute gradient-based features for structure preservation"""
@@ -85,179 +605,1297 @@ def compute_feature_map(img_arr):
     
     return gradient_mag
 
-def process_block_advanced(s_blk, t_blk, s_feat, t_feat):
-    """Advanced block processing with Hungarian algorithm and feature matching"""
-    sh, sw, _ = s_blk.shape
+def color_coordinates(arr):
+    """Convert a whole RGB image to the transport colour space in one pass"""
+    if COLOR_SPACE == "lab":
+        # rgb2lab reads float input as [0, 1]; float stage arrays are 0-255
+        if arr.dtype != np.uint8:
+            arr = np.asarray(arr) / 255.0
+        return rgb2lab(arr) * LAB_WEIGHTS
+    return np.asarray(arr, dtype=np.float32)
+
+def block_costs(s_blk, t_blk, s_feat, t_feat, s_col=None, t_col=None,
+                spatial_weight=3.0, feature_weight=1.5):
+    """Transport cost matrices for a stack of same-shaped tiles, (nb, n, n)
+
+    Tiles are (nb, bh, bw, C) and feature maps (nb, bh, bw); rows of each
+    matrix are target pixels, columns source pixels.
+    """
+    nb, sh, sw = s_blk.shape[:3]
+    n = sh * sw
     
-    # Build cost matrix
-    cost_matrix = np.zeros((sh * sw, sh * sw))
+    # Colour coordinates come precomputed per image; raw RGB otherwise
+    if s_col is None:
+        s_col, t_col = s_blk.astype(np.float32), t_blk.astype(np.float32)
     
-    for i in range(sh * sw):
-        ty, tx = i // sw, i % sw
-        
-        for j in range(sh * sw):
-            sy, sx = j // sw, j % sw
-            
-            # Color distance in LAB space for perceptual accuracy
-            color_cost = np.linalg.norm(
-                s_blk[sy, sx].astype(np.float32) - 
-                t_blk[ty, tx].astype(np.float32)
-            )
-            
-            # Spatial distance
-            spatial_cost = np.sqrt((sy - ty)**2 + (sx - tx)**2)
-            
-            # Feature similarity (gradient matching)
-            feature_cost = abs(s_feat[sy, sx] - t_feat[ty, tx])
-            
-            # Combined cost with weights
-            cost_matrix[i, j] = color_cost + 3.0 * spatial_cost + 1.5 * feature_cost
+    s_c = s_col.reshape(nb, n, -1)
+    t_c = t_col.reshape(nb, n, -1)
+    ys, xs = np.divmod(np.arange(n), sw)
+    
+    # Color distance in the chosen colour space, one channel at a time to
+    # avoid an (nb, n, n, C) temporary
+    color_cost = np.zeros((nb, n, n))
+    for c in range(s_c.shape[2]):
+        d = t_c[:, :, None, c] - s_c[:, None, :, c]
+        color_cost += d * d
+    np.sqrt(color_cost, out=color_cost)
     
-    # Hungarian algorithm for optimal assignment
-    row_ind, col_ind = linear_sum_assignment(cost_matrix)
+    # Spatial distance (the same for every tile)
+    spatial_cost = np.hypot(ys[:, None] - ys[None, :], xs[:, None] - xs[None, :])
+    
+    # Feature similarity (gradient matching)
+    feature_cost = np.abs(t_feat.reshape(nb, n)[:, :, None] - s_feat.reshape(nb, n)[:, None, :])
+    
+    # Combined cost with weights
+    return color_cost + spatial_weight * spatial_cost + feature_weight * feature_cost
+
+def block_cost(*job):
+    """Transport cost matrix for one tile job"""
+    return block_costs(*(a[None] for a in job[:6] if a is not None), *job[6:])[0]
+
+def assign_block(*job):
+    """Optimal assignment for one tile: source index for every target pixel"""
+    return solve_assignments(block_cost(*job)[None])[0]
+
+def process_block_advanced(s_blk, *args):
+    """Advanced block processing with Hungarian algorithm and feature matching"""
+    col_ind = assign_block(s_blk, *args)
     
     # Build output block
-    out = np.zeros_like(s_blk)
-    for i, j in zip(row_ind, col_ind):
-        ty, tx = i // sw, i % sw
-        sy, sx = j // sw, j % sw
-        out[ty, tx] = s_blk[sy, sx]
+    n = s_blk.shape[0] * s_blk.shape[1]
+    return s_blk.reshape(n, -1)[col_ind].reshape(s_blk.shape)
+
+# =============== ASSIGNMENT SOLVERS ==================
+def auction_assign(cost, tol=None, scale=5.0):
+    """Batched epsilon-scaling auction for (B, n, n) min-cost assignment
+
+    All unassigned rows of all problems bid at once (Jacobi auction). The
+    final epsilon is tol * cost_range / n per problem, which bounds each
+    total cost within tol * cost_range of optimal. Returns (B, n) columns.
+    """
+    tol = AUCTION_TOL if tol is None else tol
+    benefit = -np.asarray(cost, dtype=np.float64)
+    B, n, _ = benefit.shape
+    if n == 1:
+        return np.zeros((B, 1), dtype=np.intp)
+
+    span = np.maximum(np.ptp(benefit.reshape(B, -1), axis=1), 1e-12)
+    eps_final = tol * span / n
+    eps = np.maximum(span / 4, eps_final)
+    prices = np.zeros((B, n))
+
+    while True:
+        owner = np.full((B, n), -1)
+        assigned = np.full((B, n), -1)
+
+        while True:
+            ub, ui = np.nonzero(assigned < 0)
+            if ub.size == 0:
+                break
+
+            # Best and second-best net value for every bidder
+            values = benefit[ub, ui] - prices[ub]
+            rows = np.arange(ub.size)
+            j1 = values.argmax(axis=1)
+            w1 = values[rows, j1]
+            values[rows, j1] = -np.inf
+            w2 = values.max(axis=1)
+            bids = prices[ub, j1] + (w1 - w2) + eps[ub]
+
+            # Highest bid wins each contested object
+            key = ub * n + j1
+            order = np.lexsort((-bids, key))
+            first = np.ones(order.size, dtype=bool)
+            first[1:] = key[order[1:]] != key[order[:-1]]
+            win = order[first]
+
+            b, j, i = ub[win], j1[win], ui[win]
+            prev = owner[b, j]
+            outbid = prev >= 0
+            assigned[b[outbid], prev[outbid]] = -1
+            owner[b, j] = i
+            assigned[b, i] = j
+            prices[b, j] = bids[win]
+
+        if np.all(eps <= eps_final):
+            return assigned
+        eps = np.maximum(eps / scale, eps_final)
+
+def solve_assignments(cost):
+    """Row-to-column assignment for a (B, n, n) stack of cost matrices"""
+    if ASSIGNMENT_BACKEND == "auction":
+        return auction_assign(cost)
+    return np.stack([linear_sum_assignment(c)[1] for c in cost])
+
+# =============== SCHEDULER ==================
+
+def get_worker_pool():
+    """Return the persistent joblib pool, starting it on first use"""
+    global worker_pool
+    if worker_pool is None:
+        with parallel_config(backend="loky", idle_worker_timeout=POOL_IDLE_TIMEOUT):
+            worker_pool = Parallel(n_jobs=N_JOBS)
+        worker_pool.__enter__()
+    return worker_pool
+
+def worker_module():
+    """This module under its importable name, for functions sent to the pool.
+    Under `python main.py` functions belong to __main__ and would be pickled by
+    value along with the globals they reach (the pool itself among them)"""
+    if __name__ != "__main__":
+        return sys.modules[__name__]
+    import main
+    return main
+
+def shutdown_worker_pool():
+    global worker_pool
+    if worker_pool is not None:
+        worker_pool.__exit__(None, None, None)
+        worker_pool = None
+
+def warm_worker_pool():
+    """Start the pool and run a tiny solve in each worker so imports are paid up front"""
+    n_workers = effective_n_jobs(N_JOBS)
+    if n_workers <= 1:
+        return
+
+    tile = np.zeros((2, 2, 3), dtype=np.uint8)
+    feat = np.zeros((2, 2))
+    warmup = [[(tile, tile, feat, feat)] for _ in range(n_workers)]
+    get_worker_pool()(delayed(worker_module().process_block_chunk)(c) for c in warmup)
+
+    print(f"[✓] Worker pool warm ({n_workers} workers)")
+
+def process_block_chunk(chunk):
+    """Assignments for a run of tiles; same-shaped tiles are costed as one tensor"""
+    results = [None] * len(chunk)
+    groups = {}
+    for k, job in enumerate(chunk):
+        # Edge tiles can be smaller; weights could differ between callers
+        key = (job[0].shape, len(job), job[6:])
+        groups.setdefault(key, []).append(k)
+
+    for (shape, arity, weights), idx in groups.items():
+        n = shape[0] * shape[1]
+        step = max(1, SOLVE_BATCH * 64 * 64 // (n * n))
+        for i in range(0, len(idx), step):
+            part = idx[i:i+step]
+            arrays = [np.stack([chunk[k][a] for k in part]) for a in range(min(arity, 6))]
+            cols = solve_assignments(block_costs(*arrays, *weights))
+            for k, col_ind in zip(part, cols):
+                results[k] = col_ind
+
+    return results
+
+def pool_break_even(n_workers, t_block, t_transfer, t_dispatch):
+    """Tiles above which n_workers beat one process: each tile saves
+    t_block * (1 - 1/n) - t_transfer against n * t_dispatch of fixed cost"""
+    gain = t_block * (1 - 1 / n_workers) - t_transfer if n_workers > 1 else 0.0
+    if gain <= 0:
+        return float("inf")
+    return int(np.ceil(n_workers * t_dispatch / gain))
+
+def parallel_min_blocks(n_workers):
+    if PARALLEL_MIN_BLOCKS is not None:
+        return PARALLEL_MIN_BLOCKS
+    return pool_break_even(n_workers, POOL_TILE_SECONDS, POOL_TRANSFER_SECONDS, POOL_DISPATCH_SECONDS)
+
+def schedule_blocks(jobs, min_parallel=None):
+    """Assign tile jobs, one chunk per worker, or in-process when too small"""
+    n_workers = effective_n_jobs(N_JOBS)
+    if min_parallel is None:
+        min_parallel = parallel_min_blocks(n_workers)
+
+    if n_workers <= 1 or len(jobs) < min_parallel:
+        return process_block_chunk(jobs)
+
+    size = -(-len(jobs) // n_workers)
+    chunks = [jobs[i:i+size] for i in range(0, len(jobs), size)]
+    profiler.note_workers(len(chunks))
+    results = get_worker_pool()(delayed(worker_module().process_block_chunk)(c) for c in chunks)
+
+    return [col_ind for chunk in results for col_ind in chunk]
+
+def grid_rects(H, W, offset=0):
+    """BLOCK grid shifted by offset on both axes; edge tiles are clipped"""
+    ys = sorted({0, *range(offset % BLOCK or BLOCK, H, BLOCK)})
+    xs = sorted({0, *range(offset % BLOCK or BLOCK, W, BLOCK)})
+    return [(y, x, y1 - y, x1 - x)
+            for y, y1 in zip(ys, ys[1:] + [H]) for x, x1 in zip(xs, xs[1:] + [W])]
+
+def block_layout(H, W, energy=None):
+    """(y, x, h, w) tiles covering an H x W image, split into (solved, flat) lists
+
+    With PARTITION = "quadtree" each 2*BLOCK cell is split recursively by mean
+    gradient energy: flat quadrants are rank-mapped, edge-rich BLOCK tiles are
+    split down to QUADTREE_MIN ("split") or their whole cell is solved ("merge").
+    """
+    if PARTITION != "quadtree" or energy is None:
+        return grid_rects(H, W), []
+
+    # Mean energy of any rectangle from a summed-area table
+    sat = np.zeros((H + 1, W + 1))
+    sat[1:, 1:] = energy.cumsum(0).cumsum(1)
+    def mean(y, x, h, w):
+        return (sat[y+h, x+w] - sat[y, x+w] - sat[y+h, x] + sat[y, x]) / (h * w)
+
+    solved, flat = [], []
+    def split(y, x, size):
+        h, w = min(size, H - y), min(size, W - x)
+        e = mean(y, x, h, w)
+        edge = e > QUADTREE_EDGE
+        if e < QUADTREE_FLAT:
+            flat.append((y, x, h, w))
+        elif edge and QUADTREE_EDGE_MODE == "merge" and size > BLOCK:
+            solved.append((y, x, h, w))
+        elif size > BLOCK or (edge and QUADTREE_EDGE_MODE == "split" and size > QUADTREE_MIN):
+            half = size // 2
+            for dy in (0, half):
+                for dx in (0, half):
+                    if dy < h and dx < w:
+                        split(y + dy, x + dx, half)
+        else:
+            solved.append((y, x, h, w))
+
+    for y in range(0, H, 2 * BLOCK):
+        for x in range(0, W, 2 * BLOCK):
+            split(y, x, 2 * BLOCK)
+    return solved, flat
+
+def block_jobs(src, tgt, src_feat, tgt_feat, src_col, tgt_col, weights, rects=None):
+    """Per-tile job tuples and their (y, x, h, w) rectangles (default: BLOCK grid)"""
+    if rects is None:
+        rects, _ = block_layout(*src.shape[:2])
+    jobs = []
     
-    return out
+    for y, x, h, w in rects:
+        jobs.append((
+            src[y:y+h, x:x+w],
+            tgt[y:y+h, x:x+w],
+            src_feat[y:y+h, x:x+w],
+            tgt_feat[y:y+h, x:x+w],
+            src_col[y:y+h, x:x+w],
+            tgt_col[y:y+h, x:x+w],
+            *weights
+        ))
+    
+    return jobs, list(rects)
 
-def advanced_optimal_transport(source, target):
+def rank_assignments(src, tgt, rects):
+    """Flat tiles: the k-th darkest target pixel takes the k-th darkest source pixel"""
+    luma = np.array([0.299, 0.587, 0.114], dtype=np.float32)
+    s_l = np.asarray(src, dtype=np.float32) @ luma
+    t_l = np.asarray(tgt, dtype=np.float32) @ luma
+    assignments = []
+    for y, x, h, w in rects:
+        col_ind = np.empty(h * w, dtype=np.intp)
+        col_ind[np.argsort(t_l[y:y+h, x:x+w], axis=None, kind="stable")] = \
+            np.argsort(s_l[y:y+h, x:x+w], axis=None, kind="stable")
+        assignments.append(col_ind)
+    return assignments
+
+def transport_array(src, tgt, tgt_feat=None, tgt_col=None, params=None, memo=None):
+    """Block transport on arrays; the output is a rearrangement of src's pixels"""
+    return render_permutation(src, transport_permutation(src, tgt, tgt_feat, tgt_col, params, memo))
+
+def advanced_optimal_transport(source, target, tgt_feat=None, tgt_col=None, params=None):
     """Enhanced optimal transport with multiple refinements"""
-    src = np.array(source)
-    tgt = np.array(target)
-    H, W, _ = src.shape
+    out = transport_array(as_array(source), as_array(target), tgt_feat, tgt_col, params)
+    return Image.fromarray(out.astype(np.uint8))
+
+# =============== ARRAY STAGES ==================
+# Steps 2-4 work in place on one float32 (H, W, 3) buffer; pixels are
+# quantised to uint8 once, at the end, instead of after every stage.
+work_buffers = {}
+
+def work_buffer(shape):
+    """Preallocated float32 stage buffer, reused across messages of the same size"""
+    if shape not in work_buffers:
+        work_buffers[shape] = np.empty(shape, dtype=np.float32)
+    return work_buffers[shape]
+
+def lanczos_matrix(n_in, n_out, a=3):
+    """(n_out, n_in) Lanczos-3 weights laid out as PIL's LANCZOS resize"""
+    scale = n_in / n_out
+    stretch = max(scale, 1.0)
+    centers = (np.arange(n_out) + 0.5) * scale
+    d = ((np.arange(n_in) + 0.5)[None, :] - centers[:, None]) / stretch
+    w = np.sinc(d) * np.sinc(d / a) * (np.abs(d) < a)
+    return (w / w.sum(axis=1, keepdims=True)).astype(np.float32)
+
+def resize_array(arr, size):
+    """Separable Lanczos resize of an (H, W, C) array to (W, H), kept in float32"""
+    wy = lanczos_matrix(arr.shape[0], size[1])
+    wx = lanczos_matrix(arr.shape[1], size[0])
+    out = np.tensordot(wy, np.asarray(arr, dtype=np.float32), axes=(1, 0))
+    return np.einsum("xj,yjc->yxc", wx, out)
+
+def multi_scale_into(buf, src, tgt, profile=None, params=None, memo=None):
+    """Step 2: full- and half-scale transport blended straight into buf"""
+    params = params or DEFAULT_PARAMS
+    H, W = src.shape[:2]
+    full_size, half_size = (W, H), (W//2, H//2)
+    # Cached target data only applies at the profile's own resolutions
+    if profile and full_size not in profile.pyramid:
+        profile = None
+
+    # Scale 1: Full resolution
+    if profile:
+        tgt_feat, tgt_col = profile.features[full_size], profile.colors(full_size)
+    else:
+        tgt_feat, tgt_col = None, None
+    w = params["blend"]
+    with profiler.span("transport_full"):
+        np.multiply(transport_array(src, tgt, tgt_feat, tgt_col, params, memo), w, out=buf)
+
+    # Scale 2: Half resolution, resampled in float
+    with profiler.span("transport_half"):
+        src_half = resize_array(src, half_size)
+        if profile:
+            tgt_half = profile.pyramid[half_size]
+            tgt_feat, tgt_col = profile.features[half_size], profile.colors(half_size)
+        else:
+            tgt_half = resize_array(tgt, half_size)
+            tgt_feat, tgt_col = None, None
+        result_half = transport_array(src_half, tgt_half, tgt_feat, tgt_col, params, memo)
+        buf += (1 - w) * resize_array(result_half, full_size)
+    return buf
+
+def smooth_inplace(buf, sigma):
+    """Step 3: per-channel Gaussian, written back into buf"""
+    if sigma > 0:
+        for c in range(buf.shape[2]):
+            gaussian_filter(buf[:, :, c], sigma=sigma, output=buf[:, :, c])
+    return buf
+
+def contrast_inplace(buf, factor):
+    """Step 4: PIL-style contrast, scaling around the mean luminance"""
+    mean = float(np.rint(np.mean(buf @ np.array([0.299, 0.587, 0.114], dtype=np.float32))))
+    buf -= mean
+    buf *= factor
+    buf += mean
+    return buf
+
+def quantize(buf):
+    """Round the float32 buffer to publishable uint8 pixels"""
+    np.clip(buf, 0, 255, out=buf)
+    return np.rint(buf).astype(np.uint8)
+
+def edge_preserving_smooth(img, sigma=0.5):
+    """Apply gentle smoothing while preserving edges"""
+    return Image.fromarray(quantize(smooth_inplace(as_float32(img).copy(), sigma)))
+
+def local_contrast_enhancement(img, factor=1.1):
+    """Enhance local contrast to improve structure visibility"""
+    return Image.fromarray(quantize(contrast_inplace(as_float32(img).copy(), factor)))
+
+def multi_scale_transform(source, target, profile=None, params=None):
+    """Apply transformation at multiple scales and blend"""
+    src = as_array(source)
+    buf = np.empty(src.shape, dtype=np.float32)
+    multi_scale_into(buf, src, as_array(target), profile, params)
+    return Image.fromarray(quantize(buf))
+
+def transform_into(buf, matched, target, profile=None, params=None, memo=None):
+    """Steps 2-4 on a histogram-matched uint8 array, leaving the result in buf
+
+    A TileMemo carries tile assignments between frames (not used when tiled).
+    """
+    params = params or DEFAULT_PARAMS
+    H, W = matched.shape[:2]
+    if W * H > TILE_SIZE * TILE_SIZE:
+        with profiler.span("tiles"):
+            tiled_into(buf, matched, as_array(target), params)
+    else:
+        multi_scale_into(buf, matched, as_array(target), profile, params, memo)
+        with profiler.span("smooth"):
+            smooth_inplace(buf, params["sigma"])
+    with profiler.span("contrast"):
+        return contrast_inplace(buf, params["contrast"])
+
+# =============== TILED PROCESSING ==================
+@contextmanager
+def serial_blocks():
+    """Solve tiles in-process for the duration (used inside pool workers)"""
+    global N_JOBS
+    saved, N_JOBS = N_JOBS, 1
+    try:
+        yield
+    finally:
+        N_JOBS = saved
+
+def tile_windows(H, W, tile=TILE_SIZE, halo=TILE_HALO):
+    """(core, haloed) rectangles as (y0, x0, y1, x1) covering an H x W image"""
+    for y in range(0, H, tile):
+        for x in range(0, W, tile):
+            core = (y, x, min(y + tile, H), min(x + tile, W))
+            padded = (max(y - halo, 0), max(x - halo, 0),
+                      min(y + tile + halo, H), min(x + tile + halo, W))
+            yield core, padded
+
+def process_tile(src, tgt, params):
+    """Steps 2-3 of run_pipeline on one haloed tile"""
+    buf = np.empty(src.shape, dtype=np.float32)
+    with serial_blocks():
+        multi_scale_into(buf, src, tgt, None, params)
+        smooth_inplace(buf, params["sigma"])
+    return buf
+
+def tiled_into(buf, src, tgt, params=None, tile=TILE_SIZE, halo=TILE_HALO):
+    """Transport + smoothing for any resolution, a bounded wave of tiles at a time
+
+    Each tile is processed with a halo so gradients, resampling and smoothing
+    at its edges see the same neighbours as a whole-image run; only the core
+    is kept, so tiles stitch without seams beyond the usual block edges.
+    """
+    params = params or DEFAULT_PARAMS
+    H, W = src.shape[:2]
+
+    windows = list(tile_windows(H, W, tile, halo))
+    n_workers = effective_n_jobs(N_JOBS)
+    # At most two tiles per worker in flight keeps memory bounded
+    wave = 2 * max(n_workers, 1)
+
+    for i in range(0, len(windows), wave):
+        batch = windows[i:i+wave]
+        crops = [(src[y0:y1, x0:x1], tgt[y0:y1, x0:x1]) for _, (y0, x0, y1, x1) in batch]
+        if n_workers <= 1:
+            results = [process_tile(s, t, params) for s, t in crops]
+        else:
+            profiler.note_workers(min(n_workers, len(crops)))
+            task = delayed(worker_module().process_tile)
+            results = get_worker_pool()(task(s, t, params) for s, t in crops)
+
+        for ((y, x, ye, xe), (y0, x0, _, _)), res in zip(batch, results):
+            buf[y:ye, x:xe] = res[y-y0:ye-y0, x-x0:xe-x0]
+
+    return buf
+
+def tiled_transform(matched, target, params=None, tile=TILE_SIZE, halo=TILE_HALO):
+    """PIL wrapper around tiled_into"""
+    src = as_array(matched)
+    buf = np.empty(src.shape, dtype=np.float32)
+    tiled_into(buf, src, as_array(target), params, tile, halo)
+    return Image.fromarray(quantize(buf))
+
+# =============== PERMUTATION MODE ==================
+def render_permutation(src, perm):
+    """Output pixel i is source pixel perm[i]"""
+    return src.reshape(-1, src.shape[-1])[perm].reshape(src.shape)
+
+def validate_permutation(perm, n):
+    """Raise ValueError unless perm uses every source pixel exactly once"""
+    perm = np.asarray(perm)
+    if perm.shape != (n,) or perm.min() < 0 or perm.max() >= n:
+        raise ValueError(f"permutation must hold {n} indices in [0, {n})")
+    if not np.all(np.bincount(perm, minlength=n) == 1):
+        raise ValueError("permutation repeats or drops source pixels")
+
+def pixel_costs(perm, src_feat, tgt_feat, src_col, tgt_col, weights):
+    """Per-output-pixel transport cost of a flat permutation, as block_costs scores it"""
+    H, W = tgt_feat.shape
+    n = H * W
+    s_col, t_col = src_col.reshape(n, -1)[perm], tgt_col.reshape(n, -1)
+    color = np.sqrt(((t_col - s_col) ** 2).sum(axis=1))
+    (ty, tx), (sy, sx) = np.divmod(np.arange(n), W), np.divmod(perm, W)
+    spatial = np.hypot(ty - sy, tx - sx)
+    feature = np.abs(tgt_feat.ravel() - src_feat.ravel()[perm])
+    return color + weights[0] * spatial + weights[1] * feature
+
+def reconcile_permutations(perm_a, perm_b, cost_a, cost_b):
+    """Merge two permutations cycle by cycle, keeping the cheaper one on each
+
+    Output i takes source perm_a[i], which perm_b gives to output
+    inv_b[perm_a[i]]. Following that map splits the outputs into cycles, and
+    on each cycle both permutations use the same set of source pixels. So
+    choosing one permutation per cycle still gives a valid permutation.
+    """
+    n = perm_a.size
+    inv_b = np.empty(n, dtype=np.intp)
+    inv_b[perm_b] = np.arange(n)
+    graph = coo_matrix((np.ones(n), (np.arange(n), inv_b[perm_a])), shape=(n, n))
+    n_cycles, labels = connected_components(graph, directed=True, connection="weak")
+
+    gain = np.bincount(labels, weights=cost_b - cost_a, minlength=n_cycles)
+    keep_a = gain[labels] >= 0
+    return np.where(keep_a, perm_a, perm_b), np.where(keep_a, cost_a, cost_b)
+
+def compose_block_assignments(assignments, coords, shape, perm=None):
+    """Turn per-tile assignments into one flat permutation (optionally after perm)"""
+    H, W = shape
+    out = np.empty(H * W, dtype=np.intp)
+    for (y, x, bh, bw), col_ind in zip(coords, assignments):
+        by, bx = np.divmod(np.arange(bh * bw), bw)
+        rows = ((y + by) * W + x + bx)
+        out[rows] = rows[col_ind]
+    return out if perm is None else perm[out]
+
+def transport_permutation(source, target, tgt_feat=None, tgt_col=None, params=None, memo=None):
+    """Block transport that returns the pixel permutation instead of an image
+
+    With a TileMemo, tiles whose source barely changed since the memo's last
+    frame keep their previous assignment instead of being solved again.
+    """
+    params = params or DEFAULT_PARAMS
+    weights = (params["spatial_weight"], params["feature_weight"])
+    src = as_array(source)
+    tgt = as_array(target)
     
-    # Compute feature maps
     src_feat = compute_feature_map(src)
-    tgt_feat = compute_feature_map(tgt)
+    if tgt_feat is None:
+        tgt_feat = compute_feature_map(tgt)
+    src_col = color_coordinates(src)
+    if tgt_col is None:
+        tgt_col = color_coordinates(tgt)
     
-    out = np.zeros_like(src)
-    jobs, coords = [], []
+    # First grid follows PARTITION; shifted grids are uniform
+    H, W = src.shape[:2]
+    layouts = [block_layout(H, W, tgt_feat)]
+    layouts += [(grid_rects(H, W, k * BLOCK // TRANSPORT_GRIDS), [])
+                for k in range(1, TRANSPORT_GRIDS)]
     
-    for y in range(0, H, BLOCK):
-        for x in range(0, W, BLOCK):
-            jobs.append((
-                src[y:y+BLOCK, x:x+BLOCK],
-                tgt[y:y+BLOCK, x:x+BLOCK],
-                src_feat[y:y+BLOCK, x:x+BLOCK],
-                tgt_feat[y:y+BLOCK, x:x+BLOCK]
-            ))
-            coords.append((y, x))
+    # Every grid's unsolved tiles go through the scheduler as one batch
+    grids, jobs, pending = [], [], []
+    for g, (solved, _) in enumerate(layouts):
+        grid_jobs = block_jobs(src, tgt, src_feat, tgt_feat, src_col, tgt_col, weights, solved)[0]
+        grid = [None] * len(solved)
+        for i, job in enumerate(grid_jobs):
+            if memo is not None:
+                grid[i] = memo.lookup((H, W, g) + solved[i], job[0])
+            if grid[i] is None:
+                jobs.append(job)
+                pending.append((g, i))
+        grids.append(grid)
     
-    results = Parallel(n_jobs=-1)(
-        delayed(process_block_advanced)(s, t, sf, tf) for s, t, sf, tf in jobs
-    )
+    for (g, i), job, col_ind in zip(pending, jobs, schedule_blocks(jobs)):
+        grids[g][i] = col_ind
+        if memo is not None:
+            memo.store((H, W, g) + layouts[g][0][i], job[0], col_ind)
     
-    for (y, x), blk in zip(coords, results):
-        out[y:y+BLOCK, x:x+BLOCK] = blk
+    perm = cost = None
+    for (solved, flat), grid in zip(layouts, grids):
+        grid = grid + rank_assignments(src, tgt, flat)
+        grid_perm = compose_block_assignments(grid, solved + flat, (H, W))
+        if perm is None:
+            perm = grid_perm
+            if TRANSPORT_GRIDS > 1:
+                cost = pixel_costs(perm, src_feat, tgt_feat, src_col, tgt_col, weights)
+        else:
+            grid_cost = pixel_costs(grid_perm, src_feat, tgt_feat, src_col, tgt_col, weights)
+            perm, cost = reconcile_permutations(perm, grid_perm, cost, grid_cost)
     
-    return Image.fromarray(out.astype(np.uint8))
+    return perm
 
-def edge_preserving_smooth(img, sigma=0.5):
-    """Apply gentle smoothing while preserving edges"""
-    arr = np.array(img).astype(np.float32)
-    smoothed = np.zeros_like(arr)
+def smooth_permutation(src, perm, sigma, params=None):
+    """Smoothing as a permutation adjustment: re-assign rendered pixels within
+    each tile towards the Gaussian-smoothed rendering"""
+    params = params or DEFAULT_PARAMS
+    rendered = render_permutation(src, perm)
+    smoothed = np.array(edge_preserving_smooth(Image.fromarray(rendered), sigma))
     
-    for c in range(3):
-        smoothed[:, :, c] = gaussian_filter(arr[:, :, c], sigma=sigma)
+    flat = np.zeros(src.shape[:2])
+    jobs, coords = block_jobs(rendered, smoothed, flat, flat,
+                              rendered.astype(np.float32), smoothed.astype(np.float32),
+                              (params["spatial_weight"], 0.0))
+    assignments = schedule_blocks(jobs)
     
-    return Image.fromarray(smoothed.astype(np.uint8))
+    return compose_block_assignments(assignments, coords, src.shape[:2], perm)
 
-def local_contrast_enhancement(img, factor=1.1):
-    """Enhance local contrast to improve structure visibility"""
-    enhancer = ImageEnhance.Contrast(img)
-    return enhancer.enhance(factor)
-
-def multi_scale_transform(source, target):
-    """Apply transformation at multiple scales and blend"""
-    # Scale 1: Full resolution
-    result_full = advanced_optimal_transport(source, target)
+def permutation_transform(source, target, profile=None, params=None, memo=None):
+    """Pixel-rearrangement pipeline: carries a permutation of the source end to end"""
+    params = params or DEFAULT_PARAMS
+    src = as_array(source)
     
-    # Scale 2: Half resolution
-    src_half = source.resize((IMG_SIZE[0]//2, IMG_SIZE[1]//2), Image.Resampling.LANCZOS)
-    tgt_half = target.resize((IMG_SIZE[0]//2, IMG_SIZE[1]//2), Image.Resampling.LANCZOS)
-    result_half = advanced_optimal_transport(src_half, tgt_half)
-    result_half = result_half.resize(IMG_SIZE, Image.Resampling.LANCZOS)
+    # Histogram-matched colours steer the cost; rendered pixels come from source
+    cdfs = profile.cdfs if profile else None
+    with profiler.span("histogram"):
+        matched = histogram_matching(source, target, cdfs)
+    if profile and source.size in profile.pyramid:
+        tgt_feat, tgt_col = profile.features[source.size], profile.colors(source.size)
+    else:
+        tgt_feat, tgt_col = None, None
+    with profiler.span("transport"):
+        perm = transport_permutation(matched, target, tgt_feat, tgt_col, params, memo)
     
-    # Blend scales
-    arr_full = np.array(result_full).astype(np.float32)
-    arr_half = np.array(result_half).astype(np.float32)
-    blended = (0.7 * arr_full + 0.3 * arr_half).astype(np.uint8)
+    if params["sigma"] > 0:
+        with profiler.span("smooth"):
+            perm = smooth_permutation(src, perm, params["sigma"], params)
     
-    return Image.fromarray(blended)
+    validate_permutation(perm, src.shape[0] * src.shape[1])
+    return render_permutation(src, perm), perm
 
 # =============== PHASE 5 ==================
 def compute_ssim(img1, img2):
-    g1 = np.array(img1.convert("L"))
-    g2 = np.array(img2.convert("L"))
+    g1 = gray_array(img1)
+    g2 = gray_array(img2)
     return ssim(g1, g2, data_range=255)
 
+SSIM_WIN = 7
+SSIM_C1 = (0.01 * 255) ** 2
+SSIM_C2 = (0.03 * 255) ** 2
+
+def window_sums(a, k=SSIM_WIN):
+    """Sum of every fully-contained k x k window over the last two axes, via an integral image"""
+    pad = [(0, 0)] * (a.ndim - 2) + [(1, 0), (1, 0)]
+    ii = np.pad(a.cumsum(-2).cumsum(-1), pad)
+    return ii[..., k:, k:] - ii[..., :-k, k:] - ii[..., k:, :-k] + ii[..., :-k, :-k]
+
+def ssim_from_sums(sx, sy, sxx, syy, sxy):
+    """Per-window SSIM from window sums, matching skimage's default settings"""
+    n = SSIM_WIN * SSIM_WIN
+    cov_norm = n / (n - 1)
+    ux, uy = sx / n, sy / n
+    vx = cov_norm * (sxx / n - ux * ux)
+    vy = cov_norm * (syy / n - uy * uy)
+    vxy = cov_norm * (sxy / n - ux * uy)
+
+    return ((2 * ux * uy + SSIM_C1) * (2 * vxy + SSIM_C2) /
+            ((ux * ux + uy * uy + SSIM_C1) * (vx + vy + SSIM_C2)))
+
+class IncrementalSSIM:
+    """Windowed SSIM of an image being edited against a fixed target
+
+    Per-window sums of x, x^2 and x*y (and the constant y, y^2) are built once
+    from integral images. Changing a pixel only touches the k x k windows that
+    contain it, so scoring or committing a few swaps costs O(k^2) per pixel.
+    """
+
+    def __init__(self, image, target, k=SSIM_WIN):
+        self.k = k
+        self.x = np.asarray(image, dtype=np.float64).copy()
+        self.y = np.asarray(target, dtype=np.float64)
+        x, y = self.x, self.y
+
+        sums = [window_sums(a, k) for a in (x, y, x * x, y * y, x * y)]
+        self.windows = sums[0].shape
+        self.sx, self.sy, self.sxx, self.syy, self.sxy = (a.ravel() for a in sums)
+        self.map = ssim_from_sums(self.sx, self.sy, self.sxx, self.syy, self.sxy)
+        self.score = self.map.mean()
+        self._pending = None
+
+    def _touched(self, r, c):
+        """Flat indices of the windows containing pixel (r, c)"""
+        k, (wh, ww) = self.k, self.windows
+        wy = np.arange(max(r - k + 1, 0), min(r, wh - 1) + 1)
+        wx = np.arange(max(c - k + 1, 0), min(c, ww - 1) + 1)
+        return (wy[:, None] * ww + wx).ravel()
+
+    def _changes(self, swaps):
+        """Final value of every pixel the swaps move, applied in order"""
+        new = {}
+        for p, q in swaps:
+            vp, vq = new.get(p, self.x[p]), new.get(q, self.x[q])
+            new[p], new[q] = vq, vp
+        return {p: v for p, v in new.items() if v != self.x[p]}
+
+    def _evaluate(self, swaps):
+        changes = self._changes(swaps)
+        touched = [self._touched(*p) for p in changes]
+        if not touched:
+            return changes, None, None, 0.0
+
+        idx = np.unique(np.concatenate(touched))
+        sx, sxx, sxy = self.sx[idx], self.sxx[idx], self.sxy[idx]
+        for (p, new), windows in zip(changes.items(), touched):
+            old, pos = self.x[p], np.searchsorted(idx, windows)
+            sx[pos] += new - old
+            sxx[pos] += new * new - old * old
+            sxy[pos] += (new - old) * self.y[p]
+
+        after = ssim_from_sums(sx, self.sy[idx], sxx, self.syy[idx], sxy)
+        delta = (after.sum() - self.map[idx].sum()) / self.map.size
+        return changes, idx, (sx, sxx, sxy, after), delta
+
+    def delta_ssim(self, swaps):
+        """SSIM change if the ((y, x), (y, x)) pixel swaps were applied"""
+        self._pending = (swaps, self._evaluate(swaps))
+        return self._pending[1][3]
+
+    def apply(self, swaps):
+        """Commit swaps and return the SSIM change"""
+        if self._pending is not None and self._pending[0] is swaps:
+            changes, idx, sums, delta = self._pending[1]
+        else:
+            changes, idx, sums, delta = self._evaluate(swaps)
+        self._pending = None
+
+        if idx is not None:
+            self.sx[idx], self.sxx[idx], self.sxy[idx], self.map[idx] = sums
+        for p, v in changes.items():
+            self.x[p] = v
+        self.score += delta
+        return delta
+
+def batch_ssim(images, target):
+    """SSIM of each (N, H, W) grayscale image against one target in a single pass"""
+    x = np.asarray(images, dtype=np.float64)
+    y = np.asarray(target, dtype=np.float64)
+    sy, syy = window_sums(y), window_sums(y * y)
+    smap = ssim_from_sums(window_sums(x), sy, window_sums(x * x), syy, window_sums(x * y))
+    return smap.mean(axis=(-2, -1))
+
+def refine_by_swaps(img, target, budget=None, radius=None, seed=None, perm=None,
+                    max_proposals=None):
+    """Greedy pixel-swap search that keeps a swap only if SSIM improves
+
+    Stops after max_proposals SSIM evaluations (reproducible) or budget seconds,
+    defaulting to REFINE_PROPOSALS, then REFINE_BUDGET. If a flat permutation
+    is given, accepted swaps are applied to it in place.
+    """
+    if budget is None and max_proposals is None:
+        max_proposals = REFINE_PROPOSALS
+        if max_proposals is None:
+            budget = REFINE_BUDGET
+    budget = float("inf") if budget is None else budget
+    max_proposals = float("inf") if max_proposals is None else max_proposals
+    radius = REFINE_RADIUS if radius is None else radius
+    seed = REFINE_SEED if seed is None else seed
+    start = time.perf_counter()
+    rgb = np.array(as_array(img))
+    engine = IncrementalSSIM(gray_array(img), gray_array(target))
+    x, y = engine.x, engine.y
+    H, W = x.shape
+    initial = engine.score
+
+    rng = np.random.default_rng(seed)
+    proposed = accepted = 0
+
+    def sq_gain(py, px, qy, qx):
+        """Squared-error reduction against the target if the two pixels swapped"""
+        a, b, ya, yb = x[py, px], x[qy, qx], y[py, px], y[qy, qx]
+        return (a - ya) ** 2 + (b - yb) ** 2 - (b - ya) ** 2 - (a - yb) ** 2
+
+    while proposed < max_proposals and time.perf_counter() - start < budget:
+        # Random pixels and neighbours within the swap radius, drawn in bulk
+        py, px = rng.integers(0, H, 1024), rng.integers(0, W, 1024)
+        qy = np.clip(py + rng.integers(-radius, radius + 1, 1024), 0, H - 1)
+        qx = np.clip(px + rng.integers(-radius, radius + 1, 1024), 0, W - 1)
+
+        # Cheap filter: the swap must reduce squared error against the target
+        keep = np.flatnonzero(sq_gain(py, px, qy, qx) > 0)
+
+        for i in keep:
+            if proposed >= max_proposals or time.perf_counter() - start >= budget:
+                break
+            p, q = (int(py[i]), int(px[i])), (int(qy[i]), int(qx[i]))
+            # Earlier accepts in this batch may have changed either pixel
+            if sq_gain(*p, *q) <= 0:
+                continue
+            proposed += 1
+
+            swaps = [(p, q)]
+            if engine.delta_ssim(swaps) <= 0:
+                continue
+
+            engine.apply(swaps)
+            rgb[[p[0], q[0]], [p[1], q[1]]] = rgb[[q[0], p[0]], [q[1], p[1]]]
+            if perm is not None:
+                a, b = p[0] * W + p[1], q[0] * W + q[1]
+                perm[a], perm[b] = perm[b], perm[a]
+            accepted += 1
+
+    elapsed = time.perf_counter() - start
+    stats = {
+        "initial": initial,
+        "final": engine.score,
+        "proposed": proposed,
+        "accepted": accepted,
+        "seconds": elapsed,
+        "ssim_per_second": (engine.score - initial) / elapsed if elapsed else 0.0,
+    }
+
+    return rgb, stats
+
+# =============== PARAMETER SWEEP ==================
+SWEEP_GRID = {
+    "spatial_weight": [1.5, 3.0, 6.0],
+    "feature_weight": [0.0, 1.5, 3.0],
+    "blend": [0.7, 1.0],
+    "sigma": [0.0, 0.4],
+    "contrast": [1.0, 1.05],
+}
+
+def render_candidate(matched, target, profile, params):
+    """Steps 2-4 of run_pipeline under one parameter set"""
+    buf = work_buffer(matched.shape)
+    return quantize(transform_into(buf, matched, target, profile, params))
+
+def pareto_front(rows):
+    """Rows not beaten on both SSIM and runtime by any other row"""
+    front = []
+    for row in sorted(rows, key=lambda r: (r["seconds"], -r["ssim"])):
+        if not front or row["ssim"] > front[-1]["ssim"]:
+            front.append(row)
+    return front
+
+def sweep_parameters(source, target, profile=None, grid=None):
+    """Render every grid candidate, score all of them in one SSIM pass"""
+    grid = grid or SWEEP_GRID
+    keys = list(grid)
+    candidates = [dict(DEFAULT_PARAMS, **dict(zip(keys, values)))
+                  for values in itertools.product(*(grid[k] for k in keys))]
+
+    cdfs = profile.cdfs if profile else histogram_cdfs(as_array(target))
+    matched = match_histograms_lut(as_array(source), cdfs)
+
+    outputs, seconds = [], []
+    for params in candidates:
+        start = time.perf_counter()
+        out = render_candidate(matched, target, profile, params)
+        seconds.append(time.perf_counter() - start)
+        outputs.append(gray_array(out))
+
+    scores = batch_ssim(np.stack(outputs), gray_array(target))
+
+    rows = [{"params": p, "ssim": float(sc), "seconds": t}
+            for p, sc, t in zip(candidates, scores, seconds)]
+    best = max(rows, key=lambda r: r["ssim"])
+
+    return {"best": best, "rows": rows, "pareto": pareto_front(rows)}
+
+# =============== SEQUENCE MODE ==================
+class TileMemo:
+    """Previous frame's tile sources and assignments, keyed by scale, grid and rectangle"""
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+        self.tiles = {}
+        self.solved = self.reused = 0
+
+    def lookup(self, key, blk):
+        """The stored assignment if blk is within threshold of the stored tile"""
+        prev = self.tiles.get(key)
+        if prev is not None and np.abs(prev[0] - blk).mean() <= self.threshold:
+            self.reused += 1
+            return prev[1]
+        return None
+
+    def store(self, key, blk, col_ind):
+        self.tiles[key] = (np.array(blk, dtype=np.float32), col_ind)
+        self.solved += 1
+
+class FrameStream:
+    """Frames against one target, warm-started from the previous frame's tiles"""
+
+    def __init__(self, target, profile, params=None, threshold=None, refine_proposals=None):
+        self.target = target
+        self.profile = profile
+        self.params = params
+        self.memo = TileMemo(STREAM_THRESHOLD if threshold is None else threshold)
+        self.refine_proposals = (STREAM_REFINE_PROPOSALS if refine_proposals is None
+                                 else refine_proposals)
+        self.frames = 0
+
+    def push(self, frame):
+        """Transform the next frame; returns (uint8 RGB array, stats)"""
+        start = time.perf_counter()
+        solved, reused = self.memo.solved, self.memo.reused
+
+        perm = None
+        if OUTPUT_MODE == "permutation":
+            out, perm = permutation_transform(frame, self.target, self.profile,
+                                              self.params, self.memo)
+        else:
+            matched = match_histograms_lut(as_array(frame), self.profile.cdfs)
+            buf = work_buffer(matched.shape)
+            transform_into(buf, matched, self.target, self.profile, self.params, self.memo)
+            out = quantize(buf)
+        if self.refine_proposals:
+            out, _ = refine_by_swaps(out, self.target, perm=perm,
+                                     max_proposals=self.refine_proposals)
+
+        self.frames += 1
+        stats = {
+            "frame": self.frames,
+            "solved": self.memo.solved - solved,
+            "reused": self.memo.reused - reused,
+            "seconds": time.perf_counter() - start,
+        }
+        return out, stats
+
+# =============== RUN MANIFEST ==================
+def array_digest(img):
+    """SHA-256 of an image's pixels, shape and dtype"""
+    arr = np.ascontiguousarray(as_array(img))
+    digest = hashlib.sha256(f"{arr.shape}:{arr.dtype}:".encode())
+    digest.update(arr.data)
+    return digest.hexdigest()
+
+def file_digest(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def run_settings():
+    """Every setting and library version that can change run_pipeline's output"""
+    if REFINE_PROPOSALS is None:
+        refine = {"budget": REFINE_BUDGET}
+    else:
+        refine = {"proposals": REFINE_PROPOSALS}
+    refine.update(radius=REFINE_RADIUS, seed=REFINE_SEED)
+
+    return {
+        "img_size": list(IMG_SIZE),
+        "scales": [list(size) for size in pyramid_sizes()],
+        "block": BLOCK,
+        "partition": {"mode": PARTITION, "flat": QUADTREE_FLAT, "edge": QUADTREE_EDGE,
+                      "min": QUADTREE_MIN, "edge_mode": QUADTREE_EDGE_MODE},
+        "grids": TRANSPORT_GRIDS,
+        "tile": [TILE_SIZE, TILE_HALO],
+        "output_mode": OUTPUT_MODE,
+        "color_space": COLOR_SPACE,
+        "lab_weights": list(LAB_WEIGHTS),
+        "params": dict(DEFAULT_PARAMS),
+        "assignment": {"backend": ASSIGNMENT_BACKEND, "auction_tol": AUCTION_TOL},
+        "refine": refine,
+        "versions": {
+            "numpy": np.__version__, "scipy": scipy.__version__,
+            "skimage": skimage.__version__, "pillow": PIL.__version__,
+        },
+    }
+
+# Inputs the output depends on; others (e.g. the source payload hash, which
+# differs between JSON, envelope and chunked deliveries) are manifest metadata
+RUN_KEY_INPUTS = ("source_sha256", "target_file_sha256", "target_sha256")
+
+def run_key(inputs, settings):
+    """Hash of everything that determines the output; names the manifest file"""
+    keyed = {name: inputs[name] for name in RUN_KEY_INPUTS if name in inputs}
+    blob = json.dumps({"inputs": keyed, "settings": settings}, sort_keys=True)
+    return hashlib.sha256(blob.encode()).hexdigest()[:32]
+
+def build_manifest(inputs, timings, refine, score, output):
+    settings = run_settings()
+    return {
+        "run_key": run_key(inputs, settings),
+        "created": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "inputs": inputs,
+        "settings": settings,
+        "timings": {name: round(t, 6) for name, t in timings.items()},
+        "refine": dict(refine),
+        "ssim": float(score),
+        "output": {
+            "sha256": array_digest(output),
+            "png_sha256": hashlib.sha256(encode_png(output)).hexdigest(),
+        },
+    }
+
+def write_manifest(manifest, root=None):
+    """Write the manifest under its run key, flagging output drift from a previous run"""
+    root = MANIFEST_DIR if root is None else root
+    path = os.path.join(root, manifest["run_key"] + ".json")
+    try:
+        with open(path) as f:
+            previous = json.load(f)["output"]["sha256"]
+        if previous != manifest["output"]["sha256"]:
+            print(f"[!] Output differs from previous run {manifest['run_key']}")
+    except (OSError, ValueError, KeyError):
+        pass
+
+    os.makedirs(root, exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return path
+
+# =============== OLED FRAMEBUFFER ==================
+def bayer_matrix(n=8):
+    """n x n ordered-dither thresholds in (0, 1)"""
+    m = np.zeros((1, 1))
+    while m.shape[0] < n:
+        m = np.block([[4 * m, 4 * m + 2], [4 * m + 3, 4 * m + 1]])
+    return (m + 0.5) / m.size
+
+def dither_ordered(gray):
+    H, W = gray.shape
+    thresholds = np.tile(bayer_matrix(), (-(-H // 8), -(-W // 8)))[:H, :W]
+    return gray >= thresholds * 255
+
+def dither_floyd_steinberg(gray):
+    """Floyd-Steinberg, one anti-diagonal wavefront at a time
+
+    Pixel (y, x) takes error from (y, x-1) and (y-1, x-1..x+1), all of which
+    lie on earlier waves t = x + 2y, so each wave is one vectorised step.
+    """
+    H, W = gray.shape
+    g = np.asarray(gray, dtype=np.float32)
+    # err[y+1, x+1] holds the error of pixel (y, x); the border stays zero
+    err = np.zeros((H + 1, W + 2), dtype=np.float32)
+    out = np.zeros((H, W), dtype=bool)
+
+    ys, xs = np.divmod(np.arange(H * W), W)
+    wave = xs + 2 * ys
+    order = np.argsort(wave, kind="stable")
+    bounds = np.searchsorted(wave[order], np.arange(wave.max() + 2))
+
+    for t in range(wave.max() + 1):
+        idx = order[bounds[t]:bounds[t+1]]
+        y, x = ys[idx], xs[idx]
+        v = g[y, x] + (7 * err[y+1, x] + 3 * err[y, x+2] + 5 * err[y, x+1] + err[y, x]) / 16
+        bit = v >= 128
+        out[y, x] = bit
+        err[y+1, x+1] = v - 255 * bit
+    return out
+
+def dither_1bit(img, method=None):
+    """Grayscale of img at OLED_SIZE, dithered to a (H, W) bool array"""
+    gray = gray_array(img)
+    if gray.shape[::-1] != OLED_SIZE:
+        gray = np.asarray(Image.fromarray(gray).resize(OLED_SIZE, Image.Resampling.LANCZOS))
+    if (method or OLED_DITHER) == "ordered":
+        return dither_ordered(gray)
+    return dither_floyd_steinberg(gray)
+
+def pack_ssd1306(bits):
+    """Page-major SSD1306 buffer: byte x + W * page holds rows 8*page.. as bits 0..7"""
+    H, W = bits.shape
+    return np.packbits(bits.reshape(H // 8, 8, W), axis=1, bitorder="little").tobytes()
+
+def oled_delta(prev, fb, gap=3):
+    """Changed bytes of fb as [page, column, length, bytes...] runs
+
+    Unchanged gaps of up to `gap` bytes are sent inside a run, since a new
+    run costs a 3-byte header.
+    """
+    W = OLED_SIZE[0]
+    a = np.frombuffer(prev, dtype=np.uint8).reshape(-1, W)
+    b = np.frombuffer(fb, dtype=np.uint8).reshape(-1, W)
+    out = bytearray()
+    for page in range(b.shape[0]):
+        changed = np.flatnonzero(a[page] != b[page])
+        if not changed.size:
+            continue
+        for run in np.split(changed, np.flatnonzero(np.diff(changed) > gap + 1) + 1):
+            x0, x1 = int(run[0]), int(run[-1]) + 1
+            out += bytes((page, x0, x1 - x0)) + b[page, x0:x1].tobytes()
+    return bytes(out)
+
+def encode_oled_frame(img, prev=None, method=None):
+    """(framebuffer, message): b"K" + full buffer, or b"D" + runs when that is smaller"""
+    fb = pack_ssd1306(dither_1bit(img, method))
+    if prev is not None:
+        delta = oled_delta(prev, fb)
+        if len(delta) < len(fb):
+            return fb, b"D" + delta
+    return fb, b"K" + fb
+
+def apply_oled_frame(fb, message):
+    """Receiver side of encode_oled_frame: the framebuffer after message"""
+    if message[:1] == b"K":
+        return bytes(message[1:])
+    out = bytearray(fb)
+    i, W = 1, OLED_SIZE[0]
+    while i < len(message):
+        page, x0, n = message[i], message[i+1], message[i+2]
+        out[page * W + x0:page * W + x0 + n] = message[i+3:i+3+n]
+        i += 3 + n
+    return bytes(out)
+
 # =============== PHASE 6 ==================
-def publish_image(client, img):
+def encode_png(img):
     buf = io.BytesIO()
-    img.save(buf, format="PNG")
-    encoded = base64.b64encode(buf.getvalue()).decode()
+    to_image(img).save(buf, format="PNG")
+    return buf.getvalue()
+
+def publish_message(client, topic, message):
+    """Publish message whole, or chunked when it exceeds CHUNK_SIZE"""
+    if CHUNK_SIZE and len(message) > CHUNK_SIZE:
+        infos = image_codec.publish_chunked(client, topic, message, CHUNK_SIZE, CHUNK_QOS)
+        print(f"[✓] {len(message)} bytes split into {len(infos)} chunks")
+    else:
+        client.publish(topic, message)
+
+def publish_oled(client, img):
+    """Publish img as an SSD1306 key or delta frame on OLED_TOPIC"""
+    global oled_frame, oled_frames
+    prev = oled_frame if oled_frames % OLED_KEYFRAME_INTERVAL else None
+    oled_frame, message = encode_oled_frame(img, prev)
+    oled_frames += 1
+
+    kind = "key" if message[:1] == b"K" else "delta"
+    topic = OLED_TOPIC
+    if BINARY_ENVELOPE:
+        frame_type = image_codec.TYPE_SSD1306 if kind == "key" else image_codec.TYPE_SSD1306_DELTA
+        message = image_codec.pack(frame_type, *OLED_SIZE, message[1:])
+        topic = image_codec.binary_topic(OLED_TOPIC)
+    publish_message(client, topic, message)
+    print(f"[✓] OLED {kind} frame published ({len(message)} bytes)")
+
+def publish_image(client, img):
+    if PUBLISH_FORMAT == "ssd1306":
+        return publish_oled(client, img)
+    if BINARY_ENVELOPE:
+        message = image_codec.encode_image(as_array(img), BINARY_ENCODING)
+        publish_message(client, image_codec.binary_topic(TEAM_ID_REEF_ID), message)
+        print(f"[✓] Transformed image published ({BINARY_ENCODING} envelope, {len(message)} bytes)")
+        return
+
+    encoded = base64.b64encode(encode_png(img)).decode()
 
     payload = json.dumps({
         "transformed_image": encoded
     })
 
-    client.publish(TEAM_ID_REEF_ID, payload)
+    publish_message(client, TEAM_ID_REEF_ID, payload.encode())
     print("[✓] Transformed image published")
 
 # =============== MQTT =====================
 def on_connect(client, userdata, flags, rc):
     if rc == 0:
         print("[✓] MQTT connected")
-        client.subscribe(SOURCE_TOPIC)
+        for topic in image_codec.receive_topics(SOURCE_TOPIC):
+            client.subscribe(topic)
     else:
         print("[!] MQTT connection failed")
 
-def on_message(client, userdata, msg):
-    global source_image
+source_cache = LRUCache(INGEST_CACHE_SIZE)    # payload hash -> (buffer, image hash)
+result_cache = LRUCache(INGEST_CACHE_SIZE)    # run key -> (output, SSIM)
+reassembler = image_codec.Reassembler(CHUNK_TIMEOUT)
+
+def expire_chunks():
+    """Drop chunked messages that stopped arriving"""
+    for chunk_topic, msg_id, have, count in reassembler.expire():
+        print(f"[!] Chunked message {msg_id:08x} on {chunk_topic} timed out ({have}/{count} chunks)")
 
+def receive_chunk(topic, payload):
+    """(topic, message) once a chunked message is complete, else (None, None)"""
     try:
-        data = json.loads(msg.payload.decode())
-        img_bytes = base64.b64decode(data["data"])
-    except:
-        img_bytes = msg.payload
+        done = reassembler.push(topic, payload)
+    except image_codec.CodecError as e:
+        print("[!] Bad chunk:", e)
+        return None, None
+    return done or (None, None)
 
-    source_image = Image.open(io.BytesIO(img_bytes)).convert("RGB")
-    source_image = source_image.resize(IMG_SIZE, Image.Resampling.LANCZOS)
+def on_message(client, userdata, msg):
+    global source_image, source_digest
 
-    print("[✓] Source image received")
+    topic, payload = msg.topic, msg.payload
+    if image_codec.is_chunk_topic(topic):
+        topic, payload = receive_chunk(topic, payload)
+        if payload is None:
+            return
 
-    if target_ready.is_set():
-        run_pipeline(client)
+    # Repeated payloads reuse the decoded buffer (and its cached derived arrays)
+    key = (hashlib.sha256(payload).hexdigest(), IMG_SIZE, REDUCING_GAP)
+    cached = source_cache.get(key)
+    if cached is None:
+        if image_codec.is_binary_topic(topic):
+            img_bytes = payload
+        else:
+            try:
+                data = json.loads(payload.decode())
+                img_bytes = base64.b64decode(data["data"])
+            except:
+                img_bytes = payload
+
+        # Anything can land on the public topics; a payload that fails to decode
+        # must not escape the callback, or paho stops the network thread
+        try:
+            cached = decode_source(img_bytes), hashlib.sha256(img_bytes).hexdigest()
+        except image_codec.CodecError as e:
+            print("[!] Bad image envelope:", e)
+            return
+        except Exception as e:
+            print(f"[!] Undecodable payload on {topic}: {type(e).__name__}: {e}")
+            return
+        source_cache.put(key, cached)
+        print("[✓] Source image received")
     else:
+        print("[✓] Source image received (duplicate, decode skipped)")
+    source_image, source_digest = cached
+
+    if not target_ready.is_set():
         print("[!] Waiting for target image")
+        return
+    try:
+        run_pipeline(client)
+    except Exception:
+        print("[!] Pipeline failed:")
+        traceback.print_exc()
+
+def sculpt(source, target, profile, verbose=True):
+    """Steps 1-5 plus SSIM on one source/target pair, profiled as a single run"""
+    say = print if verbose else (lambda *args: None)
+    profiler.begin_run()
+
+    try:
+        perm = None
+        if OUTPUT_MODE == "permutation":
+            # Steps 1-3 as one permutation: matched cost, transport, swap-smoothing
+            say("[*] Steps 1-3: Permutation transport")
+            with profiler.span("permutation"):
+                final, perm = permutation_transform(source, target, profile)
+        else:
+            # Step 1: Histogram matching for color distribution
+            say("[*] Step 1: Histogram matching")
+            with profiler.span("histogram"):
+                matched = match_histograms_lut(as_array(source), profile.cdfs)
+            
+            # Steps 2-4 in place on one float32 buffer (tiled for large sizes)
+            say("[*] Steps 2-4: Multi-scale optimal transport, smoothing, contrast")
+            with profiler.span("transform"):
+                buf = work_buffer(matched.shape)
+                transform_into(buf, matched, target, profile)
+                final = quantize(buf)
+        
+        # Step 5: SSIM-driven swap refinement
+        say("[*] Step 5: SSIM swap refinement")
+        with profiler.span("refine"):
+            final, stats = refine_by_swaps(final, target, perm=perm)
+        say(f"[REFINE] {stats['initial']:.4f} -> {stats['final']:.4f} in {stats['seconds']:.2f}s "
+            f"({stats['ssim_per_second']:.4f} SSIM/s, {stats['accepted']}/{stats['proposed']} swaps)")
+        if perm is not None:
+            validate_permutation(perm, perm.size)
+        
+        # Compute SSIM
+        with profiler.span("ssim"):
+            score = compute_ssim(final, target)
+        say(f"[SSIM] {score:.4f}")
+    finally:
+        events = profiler.end_run()
+
+    return {"image": final, "perm": perm, "refine": stats, "ssim": score, "events": events}
+
+def run_frame(client):
+    """Sequence mode: transform the latest frame against the previous one and publish"""
+    global frame_stream
+    if frame_stream is None:
+        frame_stream = FrameStream(target_image, target_profile)
+
+    final, stats = frame_stream.push(source_image)
+    print(f"[FRAME {stats['frame']}] {stats['seconds'] * 1e3:.1f} ms, "
+          f"{stats['solved']} tiles solved, {stats['reused']} reused")
+    publish_image(client, final)
 
 def run_pipeline(client):
-    print("[*] Running advanced transformation pipeline")
+    if SEQUENCE_MODE:
+        return run_frame(client)
 
-    # Step 1: Histogram matching for color distribution
-    print("[*] Step 1: Histogram matching")
-    matched = histogram_matching(source_image, target_image)
-    
-    # Step 2: Multi-scale optimal transport
-    print("[*] Step 2: Multi-scale optimal transport")
-    transformed = multi_scale_transform(matched, target_image)
-    
-    # Step 3: Edge-preserving smoothing
-    print("[*] Step 3: Edge-preserving smoothing")
-    smoothed = edge_preserving_smooth(transformed, sigma=0.4)
-    
-    # Step 4: Local contrast enhancement
-    print("[*] Step 4: Contrast enhancement")
-    final = local_contrast_enhancement(smoothed, factor=1.05)
-    
-    # Compute SSIM
-    score = compute_ssim(final, target_image)
-    print(f"[SSIM] {score:.4f}")
+    inputs = {
+        "source_payload_sha256": source_digest,
+        "source_sha256": array_digest(source_image),
+        **target_digests,
+    }
+    # Proposal-bounded runs are deterministic: same inputs and settings, same output
+    key = run_key(inputs, run_settings())
+    cached = result_cache.get(key) if REFINE_PROPOSALS is not None else None
+    if cached is not None:
+        final, score = cached
+        print(f"[✓] Duplicate run {key}, reusing result (SSIM {score:.4f})")
+    else:
+        print("[*] Running advanced transformation pipeline")
+        result = sculpt(source_image, target_image, target_profile)
+        final, score = result["image"], result["ssim"]
+        result_cache.put(key, (final, score))
+
+        profiler.print_summary()
+        if TRACE_PATH:
+            profiler.chrome_trace(TRACE_PATH)
+
+        timings = profiler.totals(result["events"])
+        path = write_manifest(build_manifest(inputs, timings, result["refine"], score, final))
+        print(f"[✓] Manifest written to {path}")
 
     if score >= 0.70:
         publish_image(client, final)
@@ -275,9 +1913,22 @@ def main():
 
     client.on_connect = on_connect
     client.on_message = on_message
+    client.max_inflight_messages_set(CHUNK_WINDOW)
 
-    client.connect(BROKER, PORT, 60)
-    client.loop_forever()
+    # Target loads in the background while the pool warms up
+    threading.Thread(target=load_target_image_nonblocking, daemon=True).start()
+    warm_worker_pool()
+
+    try:
+        client.connect(BROKER, PORT, 60)
+        # Network loop in the background; this thread times out stalled chunks
+        client.loop_start()
+        while True:
+            time.sleep(1)
+            expire_chunks()
+    finally:
+        client.loop_stop()
+        shutdown_worker_pool()
 
 if __name__ == "__main__":
     main()
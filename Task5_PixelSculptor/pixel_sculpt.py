@@ -0,0 +1,193 @@
+#!/usr/bin/env python3
+"""
+Task 5: The Pixel Sculptor - Batch CLI
+Runs the pipeline offline over many source/target pairs (no MQTT needed)
+
+    python pixel_sculpt.py [pairs.csv] [--out DIR] [--workers N]
+
+pairs.csv has a `source,target` header and an optional `name` column; paths
+are relative to the CSV. Without a manifest the bundled pair is processed.
+Writes DIR/<name>.png, DIR/manifests/<run_key>.json and DIR/results.csv.
+Sources are decoded once into DIR/sources/*.npy and memory-mapped by workers,
+so repeated sources and re-runs skip PIL decoding.
+"""
+
+import argparse
+import csv
+import hashlib
+import os
+import time
+from joblib import Parallel, delayed
+
+import main
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+BUNDLED_PAIR = ("bundled", os.path.join(HERE, "source_image.png"),
+                os.path.join(HERE, main.TARGET_IMAGE_PATH))
+CSV_FIELDS = ["name", "source", "target", "ssim", "refine_initial", "refine_final",
+              "refine_accepted", "seconds", "output", "output_sha256", "run_key", "error"]
+
+profiles = {}
+
+
+def read_pairs(path):
+    """(name, source, target) rows of a pairs CSV, paths resolved against its folder"""
+    root = os.path.dirname(os.path.abspath(path))
+    pairs, names = [], set()
+    with open(path, newline="") as f:
+        for i, row in enumerate(csv.DictReader(f)):
+            source = os.path.join(root, row["source"].strip())
+            target = os.path.join(root, row["target"].strip())
+            name = (row.get("name") or "").strip() or os.path.splitext(os.path.basename(source))[0]
+            # Repeated sources or names must not overwrite each other's outputs
+            if name in names:
+                name = f"{name}_{i}"
+            names.add(name)
+            pairs.append((name, source, target))
+    return pairs
+
+
+def target_profile(path):
+    """Target profile per process, from the shared disk cache"""
+    if path not in profiles:
+        profiles[path], _ = main.load_target_profile(path)
+    return profiles[path]
+
+
+def source_name(digest):
+    """ImageStore name of a decoded source: payload hash plus decode settings"""
+    W, H = main.IMG_SIZE
+    return f"{digest[:32]}_{W}x{H}_gap{main.REDUCING_GAP}"
+
+
+def stage_sources(pairs, store):
+    """Decode each distinct source once into store; path -> (store name, payload sha256).
+    Unreadable sources are left out and fail in their own pair"""
+    staged = {}
+    for path in sorted({s for _, s, _ in pairs}):
+        try:
+            with open(path, "rb") as f:
+                payload = f.read()
+            digest = hashlib.sha256(payload).hexdigest()
+            name = source_name(digest)
+            if name not in store:
+                store.put(name, main.decode_source(payload))
+            staged[path] = (name, digest)
+        except Exception as e:
+            print(f"[!] Source {path} unreadable:", e)
+    return staged
+
+
+def load_source(path, staged, store_root):
+    """(ImageBuffer, payload sha256): a memmap from the store, else a fresh decode"""
+    if staged is not None:
+        name, digest = staged
+        return main.ImageStore(store_root).get(name), digest
+    with open(path, "rb") as f:
+        payload = f.read()
+    return main.decode_source(payload), hashlib.sha256(payload).hexdigest()
+
+
+def sculpt_pair(name, source_path, target_path, out_dir, staged=None):
+    """One pair through main.sculpt; returns its CSV row"""
+    # The batch pool is the parallelism; tiles are solved in-process
+    main.N_JOBS = 1
+    row = {"name": name, "source": source_path, "target": target_path}
+    start = time.perf_counter()
+
+    try:
+        profile = target_profile(target_path)
+        source, payload_digest = load_source(source_path, staged, os.path.join(out_dir, "sources"))
+        target = main.ImageBuffer(profile.pyramid[main.IMG_SIZE])
+
+        result = main.sculpt(source, target, profile, verbose=False)
+
+        output = os.path.join(out_dir, name + ".png")
+        with open(output, "wb") as f:
+            f.write(main.encode_png(result["image"]))
+
+        inputs = {
+            "source_payload_sha256": payload_digest,
+            "source_sha256": main.array_digest(source),
+            "target_file_sha256": main.file_digest(target_path),
+            "target_sha256": main.array_digest(target),
+        }
+        timings = main.profiler.totals(result["events"])
+        manifest = main.build_manifest(inputs, timings, result["refine"], result["ssim"], result["image"])
+        main.write_manifest(manifest, os.path.join(out_dir, "manifests"))
+
+        row.update({
+            "ssim": round(float(result["ssim"]), 6),
+            "refine_initial": round(float(result["refine"]["initial"]), 6),
+            "refine_final": round(float(result["refine"]["final"]), 6),
+            "refine_accepted": result["refine"]["accepted"],
+            "output": output,
+            "output_sha256": manifest["output"]["sha256"],
+            "run_key": manifest["run_key"],
+        })
+        row.update({f"{stage}_ms": round(t * 1e3, 3) for stage, t in timings.items()})
+    except Exception as e:
+        row["error"] = f"{type(e).__name__}: {e}"
+
+    row["seconds"] = round(time.perf_counter() - start, 4)
+    return row
+
+
+def write_results(rows, path):
+    stages = sorted({k for row in rows for k in row if k.endswith("_ms")})
+    with open(path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=CSV_FIELDS + stages)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def run_batch(pairs, out_dir, workers):
+    os.makedirs(out_dir, exist_ok=True)
+
+    # Build each target profile once up front so workers only read the cache
+    for target in sorted({t for _, _, t in pairs}):
+        try:
+            target_profile(target)
+        except Exception as e:
+            print(f"[!] Target {target} unreadable:", e)
+    # ...and each source decoded once, for workers to memory-map
+    staged = stage_sources(pairs, main.ImageStore(os.path.join(out_dir, "sources")))
+
+    print(f"[*] {len(pairs)} pairs on {workers} workers -> {out_dir}")
+    start = time.perf_counter()
+    rows = []
+    jobs = (delayed(sculpt_pair)(name, s, t, out_dir, staged.get(s)) for name, s, t in pairs)
+    for row in Parallel(n_jobs=workers, return_as="generator")(jobs):
+        if "error" in row:
+            print(f"[!] {row['name']}: {row['error']}")
+        else:
+            print(f"[✓] {row['name']}: SSIM {row['ssim']:.4f} in {row['seconds']:.2f}s")
+        rows.append(row)
+    elapsed = time.perf_counter() - start
+
+    csv_path = os.path.join(out_dir, "results.csv")
+    write_results(rows, csv_path)
+
+    done = [row for row in rows if "error" not in row]
+    mean = sum(row["ssim"] for row in done) / len(done) if done else float("nan")
+    print(f"[✓] {len(done)}/{len(rows)} pairs in {elapsed:.2f}s "
+          f"({len(rows) / elapsed:.2f} pairs/s), mean SSIM {mean:.4f}")
+    print(f"[✓] Results written to {csv_path}")
+    return rows
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Task 5 batch pipeline (pixel-sculpt)")
+    parser.add_argument("pairs", nargs="?", help="CSV of source,target[,name] rows")
+    parser.add_argument("--out", default="sculpt_out")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    pairs = read_pairs(args.pairs) if args.pairs else [BUNDLED_PAIR]
+    rows = run_batch(pairs, args.out, args.workers)
+    if any("error" in row for row in rows):
+        raise SystemExit(1)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+"""
+Binary image envelope shared by the MQTT scripts (Task 4, Task 5)
+
+Replaces JSON + base64 on topics ending in BINARY_SUFFIX:
+
+    offset  size  field
+    0       2     magic b"IM"
+    2       1     version
+    3       1     type       (TYPE_*)
+    4       1     encoding   (ENC_*)
+    5       2     width      (big-endian)
+    7       2     height
+    9       4     payload length
+    13      4     CRC-32 of the payload
+    17      ...   payload: pixel rows (raw or zlib) or a PNG file
+
+Types: 8-bit RGB, 8-bit gray, SSD1306 1-bit framebuffer and SSD1306 delta runs.
+
+Messages larger than a broker allows are split on "<topic>/chunk", each chunk
+prefixed with CHUNK_HEADER (magic b"IC", version, message id, index, count,
+total length, CRC-32 of the whole message) and rebuilt by Reassembler.
+"""
+
+import io
+import random
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+from PIL import Image
+
+MAGIC = b"IM"
+VERSION = 1
+HEADER = struct.Struct(">2sBBBHHII")
+BINARY_SUFFIX = "/bin"
+CHUNK_MAGIC = b"IC"
+CHUNK_HEADER = struct.Struct(">2sBIHHII")
+CHUNK_SUFFIX = "/chunk"
+
+TYPE_RGB, TYPE_GRAY, TYPE_SSD1306, TYPE_SSD1306_DELTA = 1, 2, 3, 4
+ENC_RAW, ENC_ZLIB, ENC_PNG = 0, 1, 2
+ENCODINGS = {"raw": ENC_RAW, "zlib": ENC_ZLIB, "png": ENC_PNG}
+ENCODING_NAMES = {v: k for k, v in ENCODINGS.items()}
+
+Frame = namedtuple("Frame", "type encoding width height payload")
+
+
+class CodecError(ValueError):
+    """Malformed or corrupted envelope"""
+
+
+# =============== TOPICS ==================
+def binary_topic(topic):
+    return topic + BINARY_SUFFIX
+
+
+def is_binary_topic(topic):
+    return topic.endswith(BINARY_SUFFIX)
+
+
+def chunk_topic(topic):
+    return topic + CHUNK_SUFFIX
+
+
+def is_chunk_topic(topic):
+    return topic.endswith(CHUNK_SUFFIX)
+
+
+def unchunk_topic(topic):
+    return topic[:-len(CHUNK_SUFFIX)] if is_chunk_topic(topic) else topic
+
+
+def receive_topics(topic):
+    """Every topic a message for topic can arrive on: JSON, binary, chunked"""
+    return [topic, binary_topic(topic), chunk_topic(topic), chunk_topic(binary_topic(topic))]
+
+
+def is_envelope(data):
+    return bytes(data[:2]) == MAGIC
+
+
+# =============== ENVELOPE ==================
+def pack(frame_type, width, height, payload, encoding=ENC_RAW):
+    """Header + payload; raw payloads are compressed here for ENC_ZLIB"""
+    if encoding == ENC_ZLIB:
+        payload = zlib.compress(payload, 6)
+    header = HEADER.pack(MAGIC, VERSION, frame_type, encoding, width, height,
+                         len(payload), zlib.crc32(payload))
+    return header + payload
+
+
+def unpack(data):
+    """Frame with the payload checked against length and CRC (zlib left compressed)"""
+    if len(data) < HEADER.size:
+        raise CodecError(f"envelope shorter than its {HEADER.size}-byte header")
+    magic, version, frame_type, encoding, width, height, length, crc = HEADER.unpack_from(data)
+    if magic != MAGIC or version != VERSION:
+        raise CodecError(f"not a v{VERSION} image envelope")
+
+    payload = bytes(data[HEADER.size:])
+    if len(payload) != length:
+        raise CodecError(f"payload is {len(payload)} bytes, header says {length}")
+    if zlib.crc32(payload) != crc:
+        raise CodecError("payload CRC mismatch")
+    return Frame(frame_type, encoding, width, height, payload)
+
+
+# =============== IMAGES ==================
+def encode_image(img, encoding="zlib"):
+    """Envelope for a PIL image or uint8 (H, W[, 3]) array"""
+    if isinstance(img, Image.Image):
+        img = img.convert("L" if img.mode in ("1", "L") else "RGB")
+        arr = np.asarray(img)
+    else:
+        arr = np.ascontiguousarray(img, dtype=np.uint8)
+    frame_type = TYPE_GRAY if arr.ndim == 2 else TYPE_RGB
+    height, width = arr.shape[:2]
+
+    enc = ENCODINGS[encoding]
+    if enc == ENC_PNG:
+        buf = io.BytesIO()
+        Image.fromarray(arr).save(buf, format="PNG")
+        payload = buf.getvalue()
+    else:
+        payload = arr.tobytes()
+    return pack(frame_type, width, height, payload, enc)
+
+
+def frame_pixels(frame):
+    """Pixel bytes of an unpacked frame, decompressed"""
+    if frame.encoding == ENC_ZLIB:
+        try:
+            return zlib.decompress(frame.payload)
+        except zlib.error as e:
+            raise CodecError(f"invalid zlib payload: {e}") from e
+    if frame.encoding == ENC_RAW:
+        return frame.payload
+    raise CodecError(f"encoding {frame.encoding} carries no raw pixels")
+
+
+def decode_image(data):
+    """PIL image from an RGB, gray or SSD1306 key-frame envelope (bytes or Frame)"""
+    frame = data if isinstance(data, Frame) else unpack(data)
+    if frame.encoding == ENC_PNG:
+        try:
+            img = Image.open(io.BytesIO(frame.payload))
+            img.load()
+        except (OSError, ValueError, SyntaxError) as e:
+            # PIL reports broken chunks as SyntaxError
+            raise CodecError(f"invalid PNG payload: {e}") from e
+    elif frame.type in (TYPE_RGB, TYPE_GRAY):
+        shape = (frame.height, frame.width, 3) if frame.type == TYPE_RGB else (frame.height, frame.width)
+        pixels = np.frombuffer(frame_pixels(frame), dtype=np.uint8)
+        if pixels.size != np.prod(shape):
+            raise CodecError(f"{pixels.size} pixel bytes for a {frame.width}x{frame.height} image")
+        img = Image.fromarray(pixels.reshape(shape))
+    elif frame.type == TYPE_SSD1306:
+        if frame.height % 8:
+            raise CodecError(f"SSD1306 height {frame.height} is not a whole number of pages")
+        pixels = np.frombuffer(frame_pixels(frame), dtype=np.uint8)
+        if pixels.size != frame.width * frame.height // 8:
+            raise CodecError(f"{pixels.size} bytes for a {frame.width}x{frame.height} SSD1306 frame")
+        pages = pixels.reshape(frame.height // 8, 1, frame.width)
+        bits = np.unpackbits(pages, axis=1, bitorder="little").reshape(frame.height, frame.width)
+        img = Image.fromarray(bits * 255)
+    else:
+        raise CodecError(f"frame type {frame.type} is not a standalone image")
+
+    if img.size != (frame.width, frame.height):
+        raise CodecError(f"image is {img.size}, header says {(frame.width, frame.height)}")
+    return img
+
+
+# =============== CHUNKING ==================
+message_ids = random.Random()
+
+
+def split_message(message, chunk_size):
+    """Chunks of message, each with CHUNK_HEADER; one chunk if it already fits"""
+    if chunk_size <= 0:
+        raise ValueError("chunk_size must be positive")
+    count = max(1, -(-len(message) // chunk_size))
+    if count > 0xFFFF:
+        raise ValueError(f"{len(message)} bytes need {count} chunks, more than 65535")
+
+    msg_id = message_ids.getrandbits(32)
+    crc = zlib.crc32(message)
+    view = memoryview(message)
+    return [CHUNK_HEADER.pack(CHUNK_MAGIC, VERSION, msg_id, i, count, len(message), crc)
+            + view[i * chunk_size:(i + 1) * chunk_size]
+            for i in range(count)]
+
+
+def publish_chunked(client, topic, message, chunk_size, qos=0):
+    """Publish message on chunk_topic(topic) without waiting between chunks.
+    Returns the MQTTMessageInfo of each chunk (QoS 1/2 ones pipeline up to
+    the client's max in-flight window)"""
+    topic = chunk_topic(topic)
+    return [client.publish(topic, chunk, qos=qos) for chunk in split_message(message, chunk_size)]
+
+
+class Reassembler:
+    """Receive side of publish_chunked: buffers chunks per (topic, message id)
+    and drops messages still incomplete after timeout seconds. expire() may run
+    on another thread than the MQTT loop"""
+
+    def __init__(self, timeout=10.0, remember=64):
+        self.timeout = timeout
+        self.pending = {}    # (topic, id) -> [first seen, count, length, crc, {index: bytes}]
+        # Recently completed keys, so a redelivered chunk doesn't open a new entry
+        self.completed = OrderedDict()
+        self.remember = remember
+        self.lock = threading.Lock()
+
+    def push(self, topic, data, now=None):
+        """(topic without the chunk suffix, message) once complete, else None"""
+        now = time.monotonic() if now is None else now
+        if len(data) < CHUNK_HEADER.size:
+            raise CodecError(f"chunk shorter than its {CHUNK_HEADER.size}-byte header")
+        magic, version, msg_id, index, count, length, crc = CHUNK_HEADER.unpack_from(data)
+        if magic != CHUNK_MAGIC or version != VERSION:
+            raise CodecError(f"not a v{VERSION} message chunk")
+        if index >= count:
+            raise CodecError(f"chunk {index} of {count}")
+
+        key = (topic, msg_id)
+        with self.lock:
+            if key in self.completed:
+                return None
+            entry = self.pending.setdefault(key, [now, count, length, crc, {}])
+            if entry[1:4] != [count, length, crc]:
+                del self.pending[key]
+                raise CodecError(f"chunk {index} disagrees with message {msg_id:08x}")
+            parts = entry[4]
+            parts[index] = bytes(data[CHUNK_HEADER.size:])
+            if len(parts) < count:
+                return None
+            del self.pending[key]
+            self.completed[key] = None
+            if len(self.completed) > self.remember:
+                self.completed.popitem(last=False)
+
+        message = b"".join(parts[i] for i in range(count))
+        if len(message) != length or zlib.crc32(message) != crc:
+            raise CodecError(f"message {msg_id:08x} failed its length/CRC check")
+        return unchunk_topic(topic), message
+
+    def expire(self, now=None):
+        """Drop timed-out messages; returns (topic, id, chunks received, count) for each"""
+        now = time.monotonic() if now is None else now
+        dropped = []
+        with self.lock:
+            for key, (first, count, _, _, parts) in list(self.pending.items()):
+                if now - first > self.timeout:
+                    del self.pending[key]
+                    dropped.append((key[0], key[1], len(parts), count))
+        return dropped